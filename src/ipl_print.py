@@ -1,28 +1,56 @@
 import os
-import csv
+import sys
 import argparse
 import configparser
+import ipl_sqlite
+from ipl_file import is_manifest_current
+from ipl_file import iter_playlist_file
+from ipl_file import iter_playlist_journal
+from ipl_file import read_header
+from ipl_file import read_journal
+from ipl_file import read_manifest
 from colorama import Fore
 from colorama import Style
 
-parser = argparse.ArgumentParser(description='Arguments to specify playlist ids to print.')
-parser.add_argument('-p', '--playlists', nargs='+', help='list of playlist ids to print.')
-parser.add_argument('-m', '--missing_only', action='store_true', help='list only missing items.')
-parser.add_argument('-l', '--list', action='store_true', help='list of available playlists.')
-args = parser.parse_args()
-playlists = args.playlists
-
-LIST_AVAILABLE_FLAG = args.list
-MISSING_ONLY_FLAG = args.missing_only
-MISSING_FLAG = "!"
-
-config = configparser.ConfigParser()
 src_dir = os.path.dirname(__file__)
 module_dir = os.path.join(src_dir, '..')
 config_path = os.path.join(module_dir, 'config/config.ini')
-config.read(config_path)
 
-path = config.get('params', 'path')
+MISSING_FLAG = "!"
+OUTPUT_BLOCK = 1000
+
+# Defaults, replaced by the CLI flags and config file in main()
+
+LIST_AVAILABLE_FLAG = False
+MISSING_ONLY_FLAG = False
+
+playlists = None
+path = "."
+storage = "csv"
+db_path = "playlists.db"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Arguments to specify playlist ids to print.')
+    parser.add_argument('-p', '--playlists', nargs='+', help='list of playlist ids to print.')
+    parser.add_argument('-m', '--missing_only', action='store_true', help='list only missing items.')
+    parser.add_argument('-l', '--list', action='store_true', help='list of available playlists.')
+
+    return parser.parse_args(argv)
+
+def load_config(args):
+    global LIST_AVAILABLE_FLAG, MISSING_ONLY_FLAG
+    global playlists, path, storage, db_path
+
+    playlists = args.playlists
+    LIST_AVAILABLE_FLAG = args.list
+    MISSING_ONLY_FLAG = args.missing_only
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    path = config.get('params', 'path')
+    storage = config.get('params', 'storage', fallback='csv')
+    db_path = config.get('params', 'database', fallback=os.path.join(path, 'playlists.db'))
 
 def print_column_headers():
     p0 = " Missing   "
@@ -34,11 +62,14 @@ def print_column_headers():
     print(p0, p1, p2)
     print(l0, l1, l2)
 
-def print_header_available(ids):
+def print_header_available(entries):
     print()
     print("Available playlists:")
-    for [_, _, _, count, id, name] in ids:
-        print(f"  {id} - {name} [{count}]")
+    for (id, name, count, missing) in entries:
+        if missing:
+            print(f"  {id} - {name} [{count}, {missing} missing]")
+        else:
+            print(f"  {id} - {name} [{count}]")
     print()
 
 def print_header(row):
@@ -50,17 +81,70 @@ def print_header(row):
     print()
 
 def print_read_error(id):
-    print(f"Could not read file '{id}.ipl' at '{path}'")
+    if storage == "sqlite":
+        print(f"Could not read playlist '{id}' from '{db_path}'")
+    else:
+        print(f"Could not read file '{id}.ipl' at '{path}'")
 
-def print_item(id, title, missing=False):
+def format_item(id, title, missing=False):
     p0 = "           "
     if missing:
         p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}    !      {Style.RESET_ALL}"
     p1 = f"{Style.RESET_ALL}{id}  "
     p2 = f"{Style.RESET_ALL}{title}"
-    print(p0, p1, p2)
+    return f"{p0} {p1} {p2}\n"
+
+def print_items(rows):
+    """Prints the songs of a playlist as they are read, writing the output
+    in blocks of OUTPUT_BLOCK lines instead of one write per song."""
+    block = []
+
+    for [flag, id, title] in rows:
+        is_missing = flag == MISSING_FLAG
+        if not MISSING_ONLY_FLAG or is_missing:
+            block.append(format_item(id, title, missing=is_missing))
 
-def read_playlist_file(playlist_id):
+        if len(block) >= OUTPUT_BLOCK:
+            sys.stdout.write("".join(block))
+            block.clear()
+
+    sys.stdout.write("".join(block))
+
+def list_playlist_files():
+    """Lists the stored playlists without reading their songs.
+
+    The name and counts of each .ipl file come from the manifest kept
+    next to the files. A playlist missing from the manifest, or changed
+    since it was recorded, falls back to reading only the file header,
+    which has no missing count.
+
+    Returns
+    -------
+    list
+        the playlists formatted as (playlist_id, name, count, missing),
+        where missing is None when it is not known
+    """
+    if storage == "sqlite":
+        headers = [ipl_sqlite.read_header(db_path, id) for id in ipl_sqlite.list_playlists(db_path)]
+        return [(header[4], header[5], header[3], None) for header in headers]
+
+    manifest = read_manifest(path)
+    ids = [f.split('.')[0] for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and f.endswith('.ipl')]
+    entries = []
+
+    for id in ids:
+        entry = manifest.get(id)
+        if entry is not None and is_manifest_current(path, id, entry):
+            entries.append((id, entry["name"], entry["count"], entry["missing"]))
+            continue
+
+        header = read_header(os.path.join(path, f"{id}.ipl"), os.path.join(path, f".{id}.journal")) or []
+        header = header + [""] * (6 - len(header))
+        entries.append((id, header[5], header[3], None))
+
+    return entries
+
+def read_playlist_file(playlist_id, missing_only=False):
     """Reads in a csv file of playlist information.
 
     If there is no file, or the file is empty, the function
@@ -68,37 +152,47 @@ def read_playlist_file(playlist_id):
     always the first row and formatted as:
     #file_type, version_id, playlist_origin, count, playlist_id
 
+    Rows are streamed from the file or database as they are iterated,
+    with the journal of the playlist applied on the way, and with
+    missing_only only the missing songs are read.
+
     Parameters
     ----------
     playlist_id : str
         The playlist id, used to find the csv file on disk.
+    missing_only : bool
+        Whether to read only the songs flagged as missing.
 
     Returns
     -------
-    list
-        a list of all the song items, formatted as [flag, video_id, title]
+    tuple
+        the header, and an iterable of the song items, formatted as
+        [flag, video_id, title]
     """
+    if storage == "sqlite":
+        header = ipl_sqlite.read_header(db_path, playlist_id)
+        if header is None:
+            raise KeyError(playlist_id)
+        return (header, ipl_sqlite.iter_playlist(db_path, playlist_id, missing_only))
+
     fpath = os.path.join(path, f"{playlist_id}.ipl")
+    events = read_journal(os.path.join(path, f".{playlist_id}.journal"))
+    rows = iter_playlist_journal(fpath, events, missing_only) if len(events) > 0 else iter_playlist_file(fpath, missing_only)
 
-    with open(fpath, 'r') as file:
-        reader = csv.reader(file)
-        header = next(reader)
-        items = [row for row in reader]
+    return (next(rows), rows)
 
-    return (header, items)
+def main(argv=None):
+    load_config(parse_args(argv))
 
-def main():
     if LIST_AVAILABLE_FLAG:
-        file_names = [f.split('.')[0] for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and f.endswith('.ipl')]
-        file_headers = [read_playlist_file(id)[0] for id in file_names]
-        print_header_available(file_headers)
+        print_header_available(list_playlist_files())
 
     if playlists == None:
         return
 
     for playlist in playlists:
         try:
-            (header, rows) = read_playlist_file(playlist)
+            (header, rows) = read_playlist_file(playlist, MISSING_ONLY_FLAG)
         except:
             print_read_error(playlist)
             continue
@@ -106,11 +200,7 @@ def main():
         print_header(header)
         print_column_headers()
 
-        for [flag, id, title] in rows:
-            is_missing = flag == MISSING_FLAG
-            if not MISSING_ONLY_FLAG or MISSING_ONLY_FLAG and is_missing:
-                print_item(id, title, missing=is_missing)
-
+        print_items(rows)
         print()
 
 if __name__ == "__main__":
@@ -0,0 +1,289 @@
+import argparse
+import configparser
+import contextlib
+import os
+import re
+import sqlite3
+import sys
+import ipl_sqlite
+from ipl_file import file_mtime
+from ipl_file import iter_playlist_file
+from ipl_file import iter_playlist_journal
+from ipl_file import read_journal
+from ipl_print import format_item
+from ipl_print import print_column_headers
+
+src_dir = os.path.dirname(__file__)
+module_dir = os.path.join(src_dir, '..')
+config_path = os.path.join(module_dir, 'config/config.ini')
+
+MISSING_FLAG = "!"
+
+# The index is a database of every stored song, with a full text index
+# over the titles. Each playlist is stored with a stamp of the files it
+# was read from, and is only read again once they change. The full text
+# index is filled for a whole playlist at a time, which is several times
+# faster than a trigger for each song.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    playlist_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    stamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    playlist_id TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    title TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_video ON items (video_id);
+CREATE INDEX IF NOT EXISTS items_playlist ON items (playlist_id, position);
+CREATE VIRTUAL TABLE IF NOT EXISTS titles USING fts5(
+    title,
+    content = 'items',
+    content_rowid = 'id',
+    prefix = '2 3',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+# Defaults, replaced by the CLI flags and config file in main()
+
+MISSING_ONLY_FLAG = False
+REBUILD_FLAG = False
+
+ids = []
+title = None
+path = "."
+storage = "csv"
+db_path = "playlists.db"
+index_path = ".search.db"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Search the songs of every stored playlist by video id or title.')
+    parser.add_argument('-i', '--ids', nargs='+', default=[], help='video ids to find, ending an id with * finds every id starting with it.')
+    parser.add_argument('-t', '--title', help='words to find in song titles, each matching the start of a word.')
+    parser.add_argument('-m', '--missing_only', action='store_true', help='find only missing items, or every missing item when no id or title is given.')
+    parser.add_argument('-r', '--rebuild', action='store_true', help='rebuild the index from scratch.')
+
+    return parser.parse_args(argv)
+
+def load_config(args):
+    global MISSING_ONLY_FLAG, REBUILD_FLAG
+    global ids, title, path, storage, db_path, index_path
+
+    ids = args.ids
+    title = args.title
+    MISSING_ONLY_FLAG = args.missing_only
+    REBUILD_FLAG = args.rebuild
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    path = config.get('params', 'path')
+    storage = config.get('params', 'storage', fallback='csv')
+    db_path = config.get('params', 'database', fallback=os.path.join(path, 'playlists.db'))
+    index_path = config.get('params', 'search_index', fallback=os.path.join(path, '.search.db'))
+
+@contextlib.contextmanager
+def connect(index_path):
+    """Opens the search index, creating the tables if needed. Changes are
+    committed when the block exits without an error."""
+    conn = sqlite3.connect(index_path, timeout=30)
+    try:
+        conn.executescript(SCHEMA)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def playlist_stamps():
+    """Finds every stored playlist, and a stamp that changes whenever the
+    playlist does.
+
+    The stamp of a .ipl file is the modified time of the file and its
+    journal. The database has no modified time for each playlist, so
+    every playlist in it shares the modified time of the database.
+
+    Returns
+    -------
+    dict
+        formatted as { playlist_id : stamp }
+    """
+    if storage == "sqlite":
+        stamp = str(file_mtime(db_path))
+        return { id: stamp for id in ipl_sqlite.list_playlists(db_path) }
+
+    stamps = {}
+    for f in os.listdir(path):
+        if os.path.isfile(os.path.join(path, f)) and f.endswith('.ipl'):
+            id = f.split('.')[0]
+            stamps[id] = f"{file_mtime(os.path.join(path, f))}:{file_mtime(os.path.join(path, f'.{id}.journal'))}"
+
+    return stamps
+
+def read_playlist(playlist_id):
+    """Reads in a stored playlist, with its journal replayed.
+
+    Returns
+    -------
+    tuple
+        the playlist name, and an iterable of the song items formatted
+        as [flag, video_id, title]
+    """
+    if storage == "sqlite":
+        header = ipl_sqlite.read_header(db_path, playlist_id)
+        return (header[5], ipl_sqlite.iter_playlist(db_path, playlist_id))
+
+    fpath = os.path.join(path, f"{playlist_id}.ipl")
+    events = read_journal(os.path.join(path, f".{playlist_id}.journal"))
+    rows = iter_playlist_journal(fpath, events) if len(events) > 0 else iter_playlist_file(fpath)
+    header = next(rows)
+
+    return (header[5] if len(header) > 5 else "", rows)
+
+def delete_items(conn, playlist_id):
+    conn.execute(
+        "INSERT INTO titles (titles, rowid, title) SELECT 'delete', id, title FROM items WHERE playlist_id = ?",
+        (playlist_id,))
+    conn.execute("DELETE FROM items WHERE playlist_id = ?", (playlist_id,))
+
+def update_index(conn, rebuild=False):
+    """Brings the index up to date with the stored playlists. Only the
+    playlists that changed since they were last indexed are read, and
+    playlists that are no longer stored are dropped.
+
+    Returns
+    -------
+    int
+        the number of playlists read
+    """
+    if rebuild:
+        conn.execute("INSERT INTO titles (titles) VALUES ('delete-all')")
+        conn.execute("DELETE FROM items")
+        conn.execute("DELETE FROM playlists")
+
+    stamps = playlist_stamps()
+    indexed = dict(conn.execute("SELECT playlist_id, stamp FROM playlists"))
+    changed = [id for (id, stamp) in stamps.items() if indexed.get(id) != stamp]
+
+    for id in indexed.keys() - stamps.keys():
+        delete_items(conn, id)
+        conn.execute("DELETE FROM playlists WHERE playlist_id = ?", (id,))
+
+    for id in changed:
+        try:
+            (name, rows) = read_playlist(id)
+            rows = [(id, video_id, flag, title, i) for (i, [flag, video_id, title]) in enumerate(rows)]
+        except Exception:
+            print_read_error(id)
+            continue
+
+        delete_items(conn, id)
+        conn.executemany(
+            "INSERT INTO items (playlist_id, video_id, flag, title, position) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT INTO titles (rowid, title) SELECT id, title FROM items WHERE playlist_id = ?", (id,))
+        conn.execute("INSERT OR REPLACE INTO playlists (playlist_id, name, stamp) VALUES (?, ?, ?)", (id, name, stamps[id]))
+
+    return len(changed)
+
+def title_query(text):
+    """Turns the words of a search into a full text query where every word
+    must match the start of a word in the title.
+
+    Returns
+    -------
+    str
+        the query, or None when the search has no words
+    """
+    words = re.findall(r"\w+", text)
+    if len(words) == 0:
+        return None
+
+    return " ".join(f'"{word}"*' for word in words)
+
+def search(conn, video_ids=None, text=None, missing_only=False):
+    """Finds the songs in the index matching the video ids, or the words
+    of text, or every song when neither is given.
+
+    Returns
+    -------
+    list
+        the matching songs in playlist order, formatted as
+        (playlist_id, name, flag, video_id, title)
+    """
+    conditions = []
+    params = []
+
+    if video_ids:
+        exact = [id for id in video_ids if not id.endswith("*")]
+        prefixes = [id for id in video_ids if id.endswith("*")]
+        matches = [f"items.video_id IN ({', '.join('?' * len(exact))})"] if exact else []
+        matches += ["items.video_id GLOB ?"] * len(prefixes)
+        conditions.append(f"({' OR '.join(matches)})")
+        params += exact + prefixes
+
+    if text is not None:
+        query = title_query(text)
+        if query is None:
+            return []
+        conditions.append("items.id IN (SELECT rowid FROM titles WHERE titles MATCH ?)")
+        params.append(query)
+
+    if missing_only:
+        conditions.append("items.flag = ?")
+        params.append(MISSING_FLAG)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    return conn.execute(f"""
+        SELECT items.playlist_id, playlists.name, items.flag, items.video_id, items.title
+        FROM items JOIN playlists ON playlists.playlist_id = items.playlist_id
+        {where}
+        ORDER BY items.playlist_id, items.position
+    """, params).fetchall()
+
+def print_read_error(id):
+    if storage == "sqlite":
+        print(f"Could not read playlist '{id}' from '{db_path}', skipping it")
+    else:
+        print(f"Could not read file '{id}.ipl' at '{path}', skipping it")
+
+def print_results(results):
+    if len(results) == 0:
+        print()
+        print("No matching items found.")
+        print()
+        return
+
+    playlist = None
+    for (id, name, flag, video_id, title) in results:
+        if id != playlist:
+            playlist = id
+            print()
+            print(f"{id} - {name}")
+            print_column_headers()
+        sys.stdout.write(format_item(video_id, title, missing=flag == MISSING_FLAG))
+
+    print()
+    print(f"Found {len(results)} item(s).")
+    print()
+
+def main(argv=None):
+    args = parse_args(argv)
+    load_config(args)
+
+    if not ids and title is None and not MISSING_ONLY_FLAG and not REBUILD_FLAG:
+        parse_args(["-h"])
+
+    with connect(index_path) as conn:
+        update_index(conn, REBUILD_FLAG)
+
+        if ids or title is not None or MISSING_ONLY_FLAG:
+            print_results(search(conn, ids, title, MISSING_ONLY_FLAG))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+import argparse
+import configparser
+import contextlib
+import csv
+import os
+import sqlite3
+from ipl_file import IPL_VERSION
+from ipl_file import atomic_write
+from ipl_file import fold_cache
+from ipl_file import read_cache
+from ipl_file import read_journal
+from ipl_file import replay_journal
+from ipl_file import read_rows
+from ipl_file import replay_journal_header
+from ipl_file import title_store
+from ipl_file import update_manifest
+from ipl_file import write_rows
+
+# Titles are stored once for each video in the videos table, the title
+# of an item is only stored when it differs, such as a song added to one
+# playlist before it was renamed and to another after.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    playlist_id TEXT PRIMARY KEY,
+    origin TEXT NOT NULL,
+    name TEXT NOT NULL,
+    item_count INTEGER,
+    etag TEXT
+);
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    title TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS items (
+    playlist_id TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    title TEXT,
+    position INTEGER NOT NULL,
+    rename TEXT,
+    PRIMARY KEY (playlist_id, video_id)
+);
+CREATE INDEX IF NOT EXISTS items_position ON items (playlist_id, position);
+"""
+
+# Databases written before the videos table have a title on every item
+
+MIGRATE_TITLES = """
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    title TEXT NOT NULL
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO videos (video_id, title) SELECT video_id, title FROM items ORDER BY rowid;
+ALTER TABLE items RENAME TO items_old;
+DROP INDEX IF EXISTS items_position;
+CREATE TABLE items (
+    playlist_id TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    title TEXT,
+    position INTEGER NOT NULL,
+    rename TEXT,
+    PRIMARY KEY (playlist_id, video_id)
+);
+INSERT INTO items (playlist_id, video_id, flag, title, position)
+    SELECT i.playlist_id, i.video_id, i.flag, NULLIF(i.title, v.title), i.position
+    FROM items_old i JOIN videos v ON v.video_id = i.video_id;
+DROP TABLE items_old;
+"""
+
+# Databases written before version 1.3 kept renames in .cache files
+
+MIGRATE_RENAMES = """
+ALTER TABLE items ADD COLUMN rename TEXT;
+"""
+
+MIGRATIONS = [
+    (lambda columns: columns.get("title") == 1, MIGRATE_TITLES),
+    (lambda columns: "rename" not in columns, MIGRATE_RENAMES)
+]
+
+ITEM_COLUMNS = "items.flag, items.video_id, COALESCE(items.title, videos.title), COALESCE(items.rename, '')"
+ITEM_JOIN = "items JOIN videos ON videos.video_id = items.video_id"
+
+VERSION = IPL_VERSION
+MISSING_FLAG = "!"
+
+@contextlib.contextmanager
+def connect(db_path):
+    """Opens the playlist database, creating the tables if needed.
+
+    Every call opens its own connection so the functions in this module
+    can be used from several threads at once. Changes are committed when
+    the block exits without an error.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        migrate(conn)
+        conn.executescript(SCHEMA)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def item_columns(conn):
+    return { name: notnull for (_, name, _, notnull, _, _) in conn.execute("PRAGMA table_info(items)") }
+
+def needs_migration(conn, needed):
+    """Checks whether a database written by an earlier version needs a
+    migration, never true for a new database."""
+    columns = item_columns(conn)
+    return len(columns) > 0 and needed(columns)
+
+def migrate(conn):
+    """Upgrades a database written by an earlier version. Titles are moved
+    into the videos table, keeping a title on an item only where it
+    differs, and items get a rename column."""
+    if not any(needs_migration(conn, needed) for (needed, _) in MIGRATIONS):
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for (needed, script) in MIGRATIONS:
+            if needs_migration(conn, needed):
+                for statement in script.split(";"):
+                    if statement.strip():
+                        conn.execute(statement)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def list_playlists(db_path):
+    with connect(db_path) as conn:
+        ids = conn.execute("SELECT playlist_id FROM playlists ORDER BY playlist_id").fetchall()
+
+    return [id for (id,) in ids]
+
+def read_header(db_path, playlist_id):
+    """Reads in the header of a playlist stored in the database.
+
+    Returns
+    -------
+    list
+        the header formatted the same as a .ipl file header:
+        [file_type, version_id, playlist_origin, count, playlist_id, name, item_count, etag]
+        or None if the playlist is not stored
+    """
+    with connect(db_path) as conn:
+        row = conn.execute(
+            "SELECT origin, name, item_count, etag FROM playlists WHERE playlist_id = ?",
+            (playlist_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        (count,) = conn.execute("SELECT COUNT(*) FROM items WHERE playlist_id = ?", (playlist_id,)).fetchone()
+
+    (origin, name, item_count, etag) = row
+    item_count = "" if item_count is None else str(item_count)
+
+    return ["#IPL", VERSION, origin, str(count), playlist_id, name, item_count, etag or ""]
+
+def read_playlist(db_path, playlist_id):
+    """Reads in the songs of a playlist stored in the database.
+
+    Returns
+    -------
+    list
+        a list of all the song items in order, formatted as [flag, video_id, title]
+    """
+    with connect(db_path) as conn:
+        rows = conn.execute(
+            f"SELECT {ITEM_COLUMNS} FROM {ITEM_JOIN} WHERE items.playlist_id = ? ORDER BY items.position",
+            (playlist_id,)).fetchall()
+
+    return [title_store.row(*row) for row in rows]
+
+def iter_playlist(db_path, playlist_id, missing_only=False):
+    """Yields the songs of a playlist stored in the database one at a
+    time, in order, without loading the whole playlist into memory.
+    With missing_only only the songs flagged as missing are yielded.
+    """
+    query = f"SELECT {ITEM_COLUMNS} FROM {ITEM_JOIN} WHERE items.playlist_id = ?"
+    params = (playlist_id,)
+    if missing_only:
+        query += " AND items.flag = ?"
+        params += (MISSING_FLAG,)
+
+    with connect(db_path) as conn:
+        for row in conn.execute(query + " ORDER BY items.position", params):
+            yield title_store.row(*row)
+
+def write_header(conn, playlist_id, origin, name, item_count, etag):
+    item_count = None if item_count == "" else item_count
+    conn.execute(
+        "INSERT OR REPLACE INTO playlists (playlist_id, origin, name, item_count, etag) VALUES (?, ?, ?, ?, ?)",
+        (playlist_id, origin, name, item_count, etag))
+
+def write_videos(conn, videos):
+    """Stores the title of each video not stored yet. The title of a video
+    already stored is never changed, as items rely on it."""
+    conn.executemany("INSERT OR IGNORE INTO videos (video_id, title) VALUES (?, ?)", videos)
+
+def write_playlist(db_path, rows, playlist_id, origin, name, item_count="", etag=""):
+    """Replaces every song of a playlist stored in the database.
+
+    Parameters
+    ----------
+    rows : list
+        The songs to store, formatted as: [flag, video_id, title], with
+        the latest title of renamed songs in their rename attribute
+    """
+    with connect(db_path) as conn:
+        write_header(conn, playlist_id, origin, name, item_count, etag)
+        conn.execute("DELETE FROM items WHERE playlist_id = ?", (playlist_id,))
+        write_videos(conn, [(id, title) for [_, id, title] in rows])
+        conn.executemany(
+            "INSERT OR REPLACE INTO items (playlist_id, video_id, flag, title, position, rename) "
+            "VALUES (?, ?, ?, NULLIF(?, (SELECT title FROM videos WHERE video_id = ?)), ?, NULLIF(?, ''))",
+            [(playlist_id, row[1], row[0], row[2], row[1], i, getattr(row, "rename", "")) for i, row in enumerate(rows)])
+
+def update_playlist(db_path, playlist_id, origin, name, item_count, etag, added, recovered, missing, renamed=()):
+    """Applies the changes found by a diff to a playlist stored in the
+    database, without rewriting the songs that did not change.
+
+    Added songs are placed in front of the stored songs by giving them
+    positions below the current first position, so nothing is renumbered.
+
+    Parameters
+    ----------
+    added : list
+        the added songs, formatted as (video_id, title)
+    recovered : list
+        the recovered songs, formatted as (video_id, title)
+    missing : list
+        the missing songs, formatted as (video_id, title)
+    renamed : list
+        the songs found renamed, formatted as (video_id, new_title)
+    """
+    with connect(db_path) as conn:
+        write_header(conn, playlist_id, origin, name, item_count, etag)
+
+        (first,) = conn.execute("SELECT MIN(position) FROM items WHERE playlist_id = ?", (playlist_id,)).fetchone()
+        first = (first if first is not None else 0) - len(added)
+
+        write_videos(conn, added)
+        conn.executemany(
+            "INSERT OR REPLACE INTO items (playlist_id, video_id, flag, title, position) "
+            "VALUES (?, ?, '', NULLIF(?, (SELECT title FROM videos WHERE video_id = ?)), ?)",
+            [(playlist_id, id, title, id, first + i) for i, (id, title) in enumerate(added)])
+        conn.executemany(
+            "UPDATE items SET flag = '' WHERE playlist_id = ? AND video_id = ?",
+            [(playlist_id, id) for (id, _) in recovered])
+        conn.executemany(
+            "UPDATE items SET flag = ? WHERE playlist_id = ? AND video_id = ?",
+            [(MISSING_FLAG, playlist_id, id) for (id, _) in missing])
+        conn.executemany(
+            "UPDATE items SET rename = ? WHERE playlist_id = ? AND video_id = ?",
+            [(title, playlist_id, id) for (id, title) in renamed])
+
+def import_ipl_file(db_path, fpath):
+    """Copies a .ipl file and the changes in its journal into the
+    database, replacing the stored playlist. The renames of a '.cache'
+    file left by a version before 1.3 are copied with it.
+
+    Returns
+    -------
+    str
+        the id of the imported playlist
+    """
+    with open(fpath, 'r') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = read_rows(reader)
+
+    (dir, fname) = os.path.split(fpath)
+    events = read_journal(os.path.join(dir, f".{fname[:-len('.ipl')]}.journal"))
+    if len(events) > 0:
+        header = replay_journal_header(header, events, { row[1] for row in rows })
+        rows = replay_journal(rows, events)
+
+    fold_cache(rows, read_cache(os.path.join(dir, f".{fname[:-len('.ipl')]}.cache")))
+
+    (origin, playlist_id, name) = (header[2], header[4], header[5])
+    (item_count, etag) = (header[6], header[7]) if len(header) >= 8 else ("", "")
+
+    write_playlist(db_path, rows, playlist_id, origin, name, item_count, etag)
+
+    return playlist_id
+
+def export_ipl_file(db_path, playlist_id, fpath):
+    """Writes a playlist stored in the database out as a .ipl file. The
+    journal and a '.cache' file left next to it by a version before 1.3
+    are removed, as the file holds every change and rename, and the
+    manifest is updated."""
+    header = read_header(db_path, playlist_id)
+    rows = read_playlist(db_path, playlist_id)
+
+    with atomic_write(fpath) as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        write_rows(writer, rows)
+
+    (dir, fname) = os.path.split(fpath)
+    jpath = os.path.join(dir, f".{fname[:-len('.ipl')]}.journal")
+    if os.path.exists(jpath):
+        os.remove(jpath)
+    spath = os.path.join(dir, f".{fname[:-len('.ipl')]}.cache")
+    if os.path.exists(spath):
+        os.remove(spath)
+
+    update_manifest(dir, fname[:-len('.ipl')], header[5], rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Import .ipl files into, or export them from, the playlist database.')
+    parser.add_argument('command', choices=['import', 'export'], help='copy .ipl files into the database, or out of it.')
+    parser.add_argument('-p', '--playlists', nargs='+', help='list of playlist ids to copy, defaults to all of them.')
+    parser.add_argument('-c', '--config', help='read the path and database from a specific config file.')
+    args = parser.parse_args()
+
+    src_dir = os.path.dirname(__file__)
+    module_dir = os.path.join(src_dir, '..')
+    config_path = args.config if args.config is not None else os.path.join(module_dir, 'config/config-youtube.ini')
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    path = config.get('params', 'path')
+    db_path = config.get('params', 'database', fallback=os.path.join(path, 'playlists.db'))
+
+    if args.command == 'import':
+        playlists = args.playlists
+        if playlists is None:
+            playlists = [f[:-len('.ipl')] for f in os.listdir(path) if f.endswith('.ipl')]
+
+        for playlist in playlists:
+            import_ipl_file(db_path, os.path.join(path, f"{playlist}.ipl"))
+            print(f"Imported '{playlist}.ipl' into {db_path}")
+    else:
+        playlists = args.playlists if args.playlists is not None else list_playlists(db_path)
+
+        for playlist in playlists:
+            export_ipl_file(db_path, playlist, os.path.join(path, f"{playlist}.ipl"))
+            print(f"Exported '{playlist}.ipl' from {db_path}")
+
+if __name__ == "__main__":
+    main()
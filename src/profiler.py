@@ -0,0 +1,155 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+class Profiler:
+    """Records timed spans of a run, such as fetching a page or reading a
+    file, so a slow run can be broken down afterwards.
+
+    Spans opened inside a span for a playlist are counted towards that
+    playlist, including spans opened by other functions on the same
+    thread. The profiler is disabled by default, in which case opening a
+    span records nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, playlist=None, **args):
+        """Times the enclosed block.
+
+        Yields a dict of values to record with the span, which the block
+        can add to. 'rows' counts stored rows read and 'bytes' counts the
+        response bytes of an 'api' span, the rest are only recorded.
+        """
+        if not self.enabled:
+            yield {}
+            return
+
+        parent = getattr(self.local, "playlist", None)
+        playlist = playlist if playlist is not None else parent
+        self.local.playlist = playlist
+
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(args)
+
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            self.local.playlist = parent
+            stack.pop()
+
+            with self.lock:
+                self.spans.append({
+                    "name": name,
+                    "playlist": playlist,
+                    "thread": threading.get_ident(),
+                    "start": start - self.origin,
+                    "duration": end - start,
+                    "args": args
+                })
+
+    def timed(self, fn):
+        """Decorates a function so every call is timed in a span named
+        after it."""
+        name = fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return fn(*args, **kwargs)
+            with self.span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    def record(self, **values):
+        """Adds values to the innermost span open on this thread."""
+        if not self.enabled:
+            return
+
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1].update(values)
+
+    def summary(self):
+        """Totals the recorded spans for each playlist and for the whole run.
+
+        Returns
+        -------
+        dict
+            formatted as { "total" : stats, "playlists" : { playlist_id : stats } },
+            where stats is formatted as
+            { "wall", "api_calls", "bytes", "rows", "spans" : { name : { "count", "time" } } }
+            The time of a span includes the spans opened inside it.
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+
+        total = new_stats()
+        playlists = {}
+
+        for span in spans:
+            stats = [total]
+            if span["playlist"] is not None:
+                stats.append(playlists.setdefault(span["playlist"], new_stats()))
+
+            for s in stats:
+                add_span(s, span)
+
+        for s in [total, *playlists.values()]:
+            s["wall"] = s.pop("end") - s.pop("start") if s["start"] is not None else 0.0
+
+        return { "total": total, "playlists": playlists }
+
+    def write_json(self, fpath):
+        with open(fpath, 'w') as file:
+            json.dump({ **self.summary(), "spans": self.spans }, file, indent=2)
+
+    def write_chrome_trace(self, fpath):
+        """Writes the spans in the Chrome trace event format, which can be
+        opened in chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        events = [{
+            "name": span["name"],
+            "cat": span["playlist"] or "run",
+            "ph": "X",
+            "ts": span["start"] * 1e6,
+            "dur": span["duration"] * 1e6,
+            "pid": pid,
+            "tid": span["thread"],
+            "args": { "playlist": span["playlist"], **span["args"] }
+        } for span in self.spans]
+
+        with open(fpath, 'w') as file:
+            json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, file)
+
+def new_stats():
+    return { "start": None, "end": None, "api_calls": 0, "bytes": 0, "rows": 0, "spans": {} }
+
+def add_span(stats, span):
+    end = span["start"] + span["duration"]
+    stats["start"] = span["start"] if stats["start"] is None else min(stats["start"], span["start"])
+    stats["end"] = end if stats["end"] is None else max(stats["end"], end)
+
+    args = span["args"]
+    if span["name"] == "api":
+        stats["api_calls"] += 1
+        stats["bytes"] += args.get("bytes", 0)
+    stats["rows"] += args.get("rows", 0)
+
+    by_name = stats["spans"].setdefault(span["name"], { "count": 0, "time": 0.0 })
+    by_name["count"] += 1
+    by_name["time"] += span["duration"]
+
+profiler = Profiler()
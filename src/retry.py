@@ -0,0 +1,161 @@
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class RetryableError(Exception):
+    """Raised by a call that failed in a way that may pass if tried again,
+    such as a dropped connection, a 5xx response or a rate limit.
+
+    Parameters
+    ----------
+    retry_after : float
+        Seconds the server asked to wait before trying again, or None.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a call while the circuit breaker is open."""
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, each retry waits a random time
+    between zero and base * 2^attempt seconds, capped at cap seconds.
+    Spreading the retries out keeps concurrent requests that failed
+    together from all retrying at the same moment."""
+
+    def __init__(self, retries=5, base=0.5, cap=30):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+class RateLimiter:
+    """Holds back every request to an API while it has asked us to wait.
+
+    Shared by all the threads making requests, so a Retry-After returned
+    to one of them pauses the others too instead of each finding out with
+    its own rate limited request.
+    """
+
+    def __init__(self):
+        self.until = 0
+        self.lock = threading.Lock()
+
+    def defer(self, seconds):
+        with self.lock:
+            self.until = max(self.until, time.monotonic() + seconds)
+
+    def wait(self):
+        delay = self.until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+class CircuitBreaker:
+    """Stops making calls to an API that keeps failing.
+
+    After threshold failures in a row the breaker opens and every call
+    fails straight away with CircuitOpenError. Once cooldown seconds have
+    passed calls are let through again, the first success closes the
+    breaker and another failure opens it for a further cooldown.
+    """
+
+    def __init__(self, threshold=10, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened is not None and time.monotonic() - self.opened < self.cooldown:
+                raise CircuitOpenError(f"Stopped calling the API after {self.failures} failure(s) in a row")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+def parse_retry_after(value):
+    """Reads a Retry-After header, given either in seconds or as a date.
+
+    Returns
+    -------
+    float
+        the seconds to wait, or None if there is no valid header
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def call_with_retry(fn, policy=None, limiter=None, breaker=None):
+    """Calls fn, trying again when it raises RetryableError.
+
+    Between attempts it waits for a jittered backoff from the policy, or
+    for as long as the error's Retry-After asks if that is longer. The
+    Retry-After is passed to the limiter so every other request waits as
+    well. Any other error is raised at once.
+
+    Raises
+    ------
+    RetryableError
+        the last failure, once every retry of the policy is used up
+    CircuitOpenError
+        when the breaker is open and no call is made
+    """
+    policy = policy or RetryPolicy()
+
+    for attempt in range(policy.retries + 1):
+        if breaker is not None:
+            breaker.before_call()
+        if limiter is not None:
+            limiter.wait()
+
+        try:
+            result = fn()
+        except RetryableError as err:
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt == policy.retries:
+                raise
+
+            delay = policy.delay(attempt)
+            if err.retry_after is not None:
+                if limiter is not None:
+                    limiter.defer(err.retry_after)
+                delay = max(delay, err.retry_after)
+
+            log.warning("%s, retry %d of %d in %.1f second(s).", err, attempt + 1, policy.retries, delay)
+            time.sleep(delay)
+            continue
+
+        if breaker is not None:
+            breaker.record_success()
+
+        return result
@@ -1,4 +1,5 @@
 import argparse
+import concurrent.futures
 import configparser
 import csv
 import datetime
@@ -7,10 +8,22 @@ import json
 import logging
 import os
 import progressbar
+import requests
 import spotipy
 import sys
+import threading
 from colorama import Fore
 from colorama import Style
+from ipl_file import Row
+from ipl_file import atomic_write
+from ipl_file import update_manifest
+from retry import CircuitBreaker
+from retry import CircuitOpenError
+from retry import RateLimiter
+from retry import RetryableError
+from retry import RetryPolicy
+from retry import call_with_retry
+from retry import parse_retry_after
 from spotipy.oauth2 import SpotifyOAuth
 
 # Setup paths
@@ -19,53 +32,92 @@ src_dir = os.path.dirname(__file__)
 module_dir = os.path.join(src_dir, '..')
 config_path = os.path.join(module_dir, 'config/config-spotify.ini')
 
-# Setup logging
+log = logging.getLogger(__name__)
 
-timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-log_name = f"application-spotify-{timestamp}.log"
-log_path = os.path.join(module_dir, "logs")
-log_file = os.path.join(log_path, log_name)
+MAX_LIMIT = 50
+MAX_PLAYLIST_LIMIT = 100
+MAX_RETRIES = 5
+MISSING_FLAG = "!"
+UNAVAILABLE_FLAG = "u"
+PROGRESS_THRESHOLD = 200
 
-if not os.path.exists(log_path):
-    os.makedirs(log_path)
+# Only the parts of each playlist response that are read below are
+# requested. The saved tracks endpoint has no fields filter.
 
-logging.basicConfig(filename=log_file)
-log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
+PLAYLIST_ITEM_FIELDS = "offset,total,items(track(id,name,is_local,artists(name)))"
 
-# Setup CLI arguments and flags
+# Defaults, replaced by the CLI flags and config file in main()
 
-parser = argparse.ArgumentParser(description='Flags to change the running behavior of the spotify diff script.')
-parser.add_argument('-r', '--reauth', action='store_true', help='force the script to reauthenticate.')
-parser.add_argument('-v', '--verbose', action='store_true', help='output all verbose messages.')
-parser.add_argument('-c', '--config', help='run script using specific config file.')
-args = parser.parse_args()
+REAUTH_FLAG = False
+VERBOSE_FLAG = False
 
-REAUTH_FLAG = args.reauth
-VERBOSE_FLAG = args.verbose
-config_path = args.config if args.config is not None else config_path
+playlists = []
+market = None
+path = "."
+creds_path = None
+cache_path = None
+backups = 0
+workers = 4
 
-log.info(f"Running with config file located at {config_path}.")
+requests_made = 0
+bytes_received = 0
+transfer_lock = threading.Lock()
 
-MAX_LIMIT = 50
-MISSING_FLAG = "!"
-UNAVAILABLE_FLAG = "u"
-PROGRESS_THRESHOLD = 200
+retry_policy = RetryPolicy(retries=MAX_RETRIES)
+rate_limiter = RateLimiter()
+circuit_breaker = CircuitBreaker()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Flags to change the running behavior of the spotify diff script.')
+    parser.add_argument('-r', '--reauth', action='store_true', help='force the script to reauthenticate.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='output all verbose messages.')
+    parser.add_argument('-c', '--config', help='run script using specific config file.')
+    parser.add_argument('-w', '--workers', type=int, help='number of pages to fetch concurrently.')
+
+    return parser.parse_args(argv)
+
+def setup_logging(verbose=False):
+    """Logs to one file per day, opened only once the first message is
+    written. Per-item debug messages are only logged with verbose output.
+    """
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d")
+    log_name = f"application-spotify-{timestamp}.log"
+    log_path = os.path.join(module_dir, "logs")
+    log_file = os.path.join(log_path, log_name)
 
-# Setup config
+    if not os.path.exists(log_path):
+        os.makedirs(log_path)
 
-config = configparser.ConfigParser()
-config.read(config_path)
+    logging.basicConfig(handlers=[logging.FileHandler(log_file, delay=True)], format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
 
-playlists = json.loads(config.get('params', 'playlists'))
-market = config.get('params', 'market')
-path = config.get('params', 'path')
-creds_path = config.get('params', 'secret_path')
-cache_path = config.get('params', 'cache_path')
+def load_config(args):
+    """Sets the module flags and params from the CLI arguments and the
+    config file, creating the playlist directory if it is missing.
+    """
+    global REAUTH_FLAG, VERBOSE_FLAG
+    global config_path, playlists, market, path, creds_path, cache_path, backups, workers
+
+    REAUTH_FLAG = args.reauth
+    VERBOSE_FLAG = args.verbose
+    config_path = args.config if args.config is not None else config_path
+
+    log.info(f"Running with config file located at {config_path}.")
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
 
-if not os.path.exists(path):
-    log.warning(f"Could not find path {path}, creating directories.")
-    os.makedirs(path)
+    playlists = json.loads(config.get('params', 'playlists'))
+    market = config.get('params', 'market')
+    path = config.get('params', 'path')
+    creds_path = config.get('params', 'secret_path')
+    cache_path = config.get('params', 'cache_path')
+    backups = config.getint('params', 'backups', fallback=0)
+    workers = args.workers if args.workers is not None else config.getint('params', 'workers', fallback=4)
+
+    if not os.path.exists(path):
+        log.warning(f"Could not find path {path}, creating directories.")
+        os.makedirs(path)
 
 def auth():
     with open(creds_path, 'r') as file:
@@ -87,21 +139,50 @@ def auth():
         client_secret=creds['client_secret'],
         redirect_uri=creds['redirect_uri'],
         cache_path=cache_path
-    ))
+    ), requests_session=create_session())
 
     sys.stdout = sys.__stdout__
     sys.stderr = sys.__stderr__
 
     return client
 
+def create_session():
+    """Creates the http session of the client, with a connection for each
+    worker.
+
+    Spotipy's own session retries rate limited and failed requests by
+    itself, and once those retries run out it raises a 429 without the
+    response headers. This session makes no retries, so every failure
+    reaches fetch_page_with_retry with its Retry-After and each attempt
+    is counted.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1), max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks['response'].append(count_response)
+
+    return session
+
+def count_response(res, *args, **kwargs):
+    """Counts the requests made and response bytes received by the client,
+    so they can be reported at the end of a run. The bytes are those sent
+    over the wire, counted by the raw stream before gzip was decoded."""
+    global requests_made, bytes_received
+
+    res.content
+    with transfer_lock:
+        requests_made += 1
+        bytes_received += res.raw.tell()
+
 def fetch_username(client):
     return client.current_user()['display_name']
 
 def fetch_playlist_name(client, id):
-    return client.playlist(playlist_id=id)['name']
+    return client.playlist(playlist_id=id, fields='name')['name']
 
 def fetch_playlist_page(client, id, offset=0):
-    resp = client.playlist_items(playlist_id=id, limit=100, offset=offset)
+    resp = client.playlist_items(playlist_id=id, fields=PLAYLIST_ITEM_FIELDS, limit=MAX_PLAYLIST_LIMIT, offset=offset)
     items = filter(lambda i: not i['track']['is_local'], resp['items'])
 
     items = { i['track']['id']: f"{i['track']['artists'][0]['name']} - {i['track']['name']}" for i in items }
@@ -110,23 +191,66 @@ def fetch_playlist_page(client, id, offset=0):
 
     return (items, count, total)
 
-def fetch_playlist(client, id):
-    (fetched, count, total) = fetch_playlist_page(client, id)
+def fetch_page_with_retry(fetch_page, offset):
+    """Fetches one page, trying again with a jittered backoff when the
+    request is rate limited, fails with a 5xx response or loses its
+    connection. A Retry-After header holds back the pages fetched by
+    every other thread too."""
+    def attempt():
+        try:
+            return fetch_page(offset)
+        except spotipy.SpotifyException as err:
+            if err.http_status != 429 and err.http_status < 500:
+                raise
+            retry_after = parse_retry_after((err.headers or {}).get('Retry-After'))
+            raise RetryableError(f"Status {err.http_status} fetching offset {offset}", retry_after) from err
+        except (requests.ConnectionError, requests.Timeout) as err:
+            raise RetryableError(f"Could not connect fetching offset {offset}") from err
+
+    return call_with_retry(attempt, retry_policy, rate_limiter, circuit_breaker)
+
+def fetch_pages(fetch_page, limit):
+    """Fetches every page of a playlist or library.
+
+    The first page gives the total number of items, so the offsets of
+    all the remaining pages are known up front and are fetched by up to
+    `workers` threads at once. Pages are merged in offset order.
+
+    Parameters
+    ----------
+    fetch_page : function
+        Fetches the page at an offset, returning (items, count, total).
+    limit : int
+        The number of items in each page.
+
+    Returns
+    -------
+    dict
+        the fetched items, formatted as { id : title }
+    """
+    (fetched, count, total) = fetch_page_with_retry(fetch_page, 0)
 
     if total > PROGRESS_THRESHOLD:
         progress = progressbar.ProgressBar(max_value=total)
 
-    while count < total:
-        if total > PROGRESS_THRESHOLD:
-            progress.update(count)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pages = executor.map(lambda offset: fetch_page_with_retry(fetch_page, offset), range(count, total, limit))
 
-        (items, count, total) = fetch_playlist_page(client, id, count)
-        fetched.update(items)
+        for (items, _, _) in pages:
+            count = min(count + limit, total)
+            if total > PROGRESS_THRESHOLD:
+                progress.update(count)
+            fetched.update(items)
 
     if total > PROGRESS_THRESHOLD:
-        progress.update(len(fetched))
+        progress.update(total)
         progress.finish()
 
+    return fetched
+
+def fetch_playlist(client, id):
+    fetched = fetch_pages(lambda offset: fetch_playlist_page(client, id, offset), MAX_PLAYLIST_LIMIT)
+
     print_verbose_and_log(f"Fetched {len(fetched)} item(s) from playlist {id}")
 
     return fetched
@@ -142,21 +266,7 @@ def fetch_library_page(client, offset=0):
     return (items, count, total)
 
 def fetch_library(client):
-    (fetched, count, total) = fetch_library_page(client)
-
-    if total > PROGRESS_THRESHOLD:
-        progress = progressbar.ProgressBar(max_value=total)
-
-    while count < total:
-        if total > PROGRESS_THRESHOLD:
-            progress.update(count)
-
-        (items, count, total) = fetch_library_page(client, count)
-        fetched.update(items)
-
-    if total > PROGRESS_THRESHOLD:
-        progress.update(len(fetched))
-        progress.finish()
+    fetched = fetch_pages(lambda offset: fetch_library_page(client, offset), MAX_LIMIT)
 
     print_verbose_and_log(f"Fetched {len(fetched)} item(s) from user's library")
 
@@ -180,6 +290,22 @@ def print_err_plnotfound(id):
     p2 = f"{Style.RESET_ALL}{Style.DIM}[{id}]{Style.RESET_ALL}"
     print(p0, p1, p2)
 
+def print_err_readfile(file):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Could not read file {Fore.RED}{file}{Style.RESET_ALL}, playlist was not updated"
+    print("  ", p0, p1)
+
+def print_err_fetch():
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Could not fetch playlist from {Fore.RED}Spotify{Style.RESET_ALL}, playlist was not updated"
+    print("  ", p0, p1)
+
+def print_err_unavailable():
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}The API stopped responding after several retries, remaining playlists will be synced on the next run"
+    print(p0, p1)
+    print()
+
 def print_info_added(id, title):
     p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.GREEN}+{Style.RESET_ALL}"
     p1 = f"{Style.RESET_ALL}New song {Fore.GREEN}{title}{Style.RESET_ALL} found"
@@ -234,18 +360,39 @@ def print_warn_writingfile(file):
     p1 = f"{Style.RESET_ALL}Writing to file {Fore.YELLOW}{file}{Style.RESET_ALL}"
     print("  ", p0, p1)
 
-def print_verbose_and_log(msg, condition=True, error=None):
+def print_verbose_and_log(msg, *args, condition=True, error=None):
+    """Logs a message and prints it when verbose output is on.
+
+    The message may be a %-style format string, in which case it is only
+    formatted with args if it is printed or written to the log.
+    """
     if condition and error:
-        log.error(msg)
+        log.error(msg, *args)
         log.exception(error)
     elif condition:
-        log.info(msg)
+        log.info(msg, *args)
 
     if not VERBOSE_FLAG or not condition:
         return
 
     p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.WHITE}»{Style.RESET_ALL}"
-    p1 = f"{Style.RESET_ALL}{msg}"
+    p1 = f"{Style.RESET_ALL}{msg % args if args else msg}"
+    print(p0, p1)
+
+def print_verbose_item(msg, *args):
+    """Logs and prints a message about a single item at debug level.
+
+    Used from the per-item diff loops, which also check VERBOSE_FLAG
+    before calling, so nothing is formatted, logged or even called for
+    each item unless verbose output is on.
+    """
+    if not VERBOSE_FLAG:
+        return
+
+    log.debug(msg, *args)
+
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.WHITE}»{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}{msg % args}"
     print(p0, p1)
 
 def is_empty(list):
@@ -254,11 +401,13 @@ def is_empty(list):
 def read_playlist_file(playlist_id):
     """Reads in a csv file of playlist information.
 
-    If there is no file, or the file is empty, the function
-    will return an empty list.The header of the file is 
-    always the first row and formatted as:
+    If there is no file the function will return an empty list. The
+    header of the file is always the first row and formatted as:
     #file_type, version_id, playlist_origin, count, playlist_id
 
+    A file that exists but cannot be parsed, or holds fewer rows than
+    its header count, raises an error instead of being treated as empty.
+
     Parameters
     ----------
     playlist_id : str
@@ -269,27 +418,31 @@ def read_playlist_file(playlist_id):
     list
         a list of all the song items, formatted as [flag, video_id, title]
     """
-    try:
-        fpath = os.path.join(path, f"{playlist_id}.ipl")
+    fname = f"{playlist_id}.ipl"
+    fpath = os.path.join(path, fname)
 
-        with open(fpath, 'r') as file:
-            reader = csv.reader(file)
-            next(reader)
-            items = [row for row in reader]
+    if not os.path.exists(fpath):
+        print_verbose_and_log(f"Could not find {fname} file.")
+        return []
 
-        print_verbose_and_log(f"Read {len(items)} row(s) from '{playlist_id}.ipl'")
+    with open(fpath, 'r') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        items = [Row(flag, id, title) for [flag, id, title] in reader]
 
-        if VERBOSE_FLAG:
-            missing = 0
-            for item in items:
-                if item[0] == MISSING_FLAG:
-                    missing += 1
-            print_verbose_and_log(f"{missing} item(s) already marked as missing.")
+    if int(header[3]) != len(items):
+        raise ValueError(f"'{fname}' has {len(items)} row(s) but its header expects {header[3]}, the file may be truncated.")
 
-        return items
-    except Exception as err:
-        print_verbose_and_log(f"Error occured while reading playlist file for {playlist_id}.", error=err)
-        return []
+    print_verbose_and_log(f"Read {len(items)} row(s) from '{fname}'")
+
+    if VERBOSE_FLAG:
+        missing = 0
+        for item in items:
+            if item[0] == MISSING_FLAG:
+                missing += 1
+        print_verbose_and_log(f"{missing} item(s) already marked as missing.")
+
+    return items
 
 def write_playlist_file(rows, playlist_id, name):
     """Writes in a csv file the playlist information and songs.
@@ -309,12 +462,14 @@ def write_playlist_file(rows, playlist_id, name):
     header = ["#IPL", "1.1", "SPOTIFY", len(rows), playlist_id, name]
 
     print_verbose_and_log(f"Writing {len(rows)} row(s) to '{playlist_id}.ipl'")
-    with open(fpath, 'w+') as file:
+    with atomic_write(fpath, backups) as file:
         writer = csv.writer(file)
         writer.writerow(header)
         for row in rows:
             writer.writerow(row)
 
+    update_manifest(path, playlist_id, name, rows)
+
 def find_added_items(master, new_items):
     """Compares the items from the new_items list and master list,
     and finds all the added items.
@@ -331,18 +486,19 @@ def find_added_items(master, new_items):
     list
         a list of all the added songs, formatted as (video_id, title)
     """
+    verbose = VERBOSE_FLAG
     added = []
     index = 0
     old_items = { i[1]: i for i in master }
     for id, title in new_items.items():
         if id not in old_items:
-            print_verbose_and_log(f"Found unrecognized id {id} - {title}")
+            if verbose:
+                print_verbose_item("Found unrecognized id %s - %s", id, title)
             added.append((id, title))
-            master.insert(index, ["", id, title])
+            master.insert(index, Row("", id, title))
             index += 1
 
-    print_verbose_and_log("No unrecognized ids found. ", condition=is_empty(added))
-    print_verbose_and_log(f"{len(added)} unrecognized id(s) found. ", condition=not is_empty(added))
+    print_verbose_and_log("%d unrecognized id(s) found.", len(added))
 
     return added
 
@@ -362,15 +518,16 @@ def find_recovered_items(master, new_items):
     list
         a list of all the recovered songs, formatted as (video_id, title)
     """
+    verbose = VERBOSE_FLAG
     recovered = []
     for i, [flag, id, title] in enumerate(master):
         if id in new_items and flag == MISSING_FLAG:
-            print_verbose_and_log(f"Found recovered id {id} - {title}")
+            if verbose:
+                print_verbose_item("Found recovered id %s - %s", id, title)
             recovered.append((id, title))
-            master[i] = ["", id, title]
+            master[i] = Row("", id, title)
 
-    print_verbose_and_log("No recovered ids found. ", condition=is_empty(recovered))
-    print_verbose_and_log(f"{len(recovered)} recovered id(s) found. ", condition=not is_empty(recovered))
+    print_verbose_and_log("%d recovered id(s) found.", len(recovered))
 
     return recovered
 
@@ -390,36 +547,57 @@ def find_missing_items(master, new_items):
     list
         a list of all the missing songs, formatted as (video_id, title)
     """
+    verbose = VERBOSE_FLAG
     missing = []
     for i, [flag, id, title] in enumerate(master):
         if id not in new_items and flag != MISSING_FLAG:
-            print_verbose_and_log(f"Found missing id at position {i}, {master[i]}")
+            if verbose:
+                print_verbose_item("Found missing id at position %d, %s", i, master[i])
             master[i][0] = MISSING_FLAG
             missing.append((id, title))
 
-    print_verbose_and_log("No missing ids found. ", condition=is_empty(missing))
-    print_verbose_and_log(f"{len(missing)} missing id(s) found. ", condition=not is_empty(missing))
+    print_verbose_and_log("%d missing id(s) found.", len(missing))
 
     return missing
 
-def main():
-    client = auth()
-    user = fetch_username(client)
-    print_head_signin(user)
-    print()
+def sync_playlist(playlist, name, fetch):
+    """Fetches a playlist, diffs it against the stored items, prints the
+    changes and writes them back to the .ipl file.
 
-    # Check for user library
-
-    playlist = 'spotify_library'
-    name = 'Library'
+    A stored file that cannot be read is reported and the playlist is
+    skipped, so one damaged file does not stop the other playlists. A
+    fetch that runs out of retries, or finds the circuit breaker open, is
+    reported and raised again, as the playlists after it would fail too.
 
+    Parameters
+    ----------
+    playlist : str
+        The playlist id, used to find the csv file on disk.
+    name : str
+        The playlist title.
+    fetch : function
+        Fetches the current items of the playlist, formatted as { id : title }.
+    """
     print_head_fetching(playlist, name)
 
-    master = read_playlist_file(playlist)
-    new = fetch_library(client)
-
     fname = f"{playlist}.ipl"
     fpath = os.path.join(path, fname)
+
+    try:
+        master = read_playlist_file(playlist)
+    except Exception as err:
+        print_verbose_and_log(f"Could not read stored items of playlist {playlist}, skipping.", error=err)
+        print_err_readfile(fname)
+        print()
+        return
+
+    try:
+        new = fetch()
+    except (RetryableError, CircuitOpenError):
+        print_err_fetch()
+        print()
+        raise
+
     if not os.path.exists(fpath):
         print_warn_filenotfound(fname)
 
@@ -455,57 +633,37 @@ def main():
 
     print()
 
-    # Check for all other playlists
-
-    for playlist in playlists:
-        try:
-            name = fetch_playlist_name(client, playlist)
-            print_head_fetching(playlist, name)
-        except Exception as err:
-            print_verbose_and_log(f"Playlist {playlist} not found.", error=err)
-            print_err_plnotfound(playlist)
-            continue
-
-        master = read_playlist_file(playlist)
-        new = fetch_playlist(client, playlist)
-
-        fname = f"{playlist}.ipl"
-        fpath = os.path.join(path, fname)
-        if not os.path.exists(fpath):
-            print_warn_filenotfound(fname)
-
-        added = find_added_items(master, new)
-        recovered = find_recovered_items(master, new)
-        missing = find_missing_items(master, new)
-
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.verbose)
+    load_config(args)
 
-        for item in added:
-            id = item[0]
-            title = item[1]
-            print_info_added(id, title)
-
-        for item in recovered:
-            id = item[0]
-            title = item[1]
-            print_info_recovered(id, title)
+    client = auth()
+    user = fetch_username(client)
+    print_head_signin(user)
+    print()
 
-        for item in missing:
-            id = item[0]
-            title = item[1]
-            print_info_missing(id, title)
+    try:
+        # Check for user library
 
+        sync_playlist('spotify_library', 'Library', lambda: fetch_library(client))
 
-        if not is_empty(added) or not is_empty(missing) or not is_empty(recovered):
-            if not os.path.exists(fpath):
-                print_warn_createfile(fname)
-            print_warn_writingfile(fname)
-            write_playlist_file(master, playlist, name)
+        # Check for all other playlists
 
-        else:
-            print_info_nochanges()
+        for playlist in playlists:
+            try:
+                name = fetch_playlist_name(client, playlist)
+            except Exception as err:
+                print_verbose_and_log(f"Playlist {playlist} not found.", error=err)
+                print_err_plnotfound(playlist)
+                continue
 
-        print()
+            sync_playlist(playlist, name, lambda: fetch_playlist(client, playlist))
+    except (RetryableError, CircuitOpenError) as err:
+        print_verbose_and_log("The API is unavailable, stopping the sync.", error=err)
+        print_err_unavailable()
 
+    print_verbose_and_log("Received %d byte(s) in %d request(s).", bytes_received, requests_made)
     log.info("Script exited successfully.")
 
 if __name__ == "__main__":
@@ -1,21 +1,49 @@
 import argparse
+import concurrent.futures
 import configparser
 import csv
 import datetime
 import httplib2
 import io
+import ipl_sqlite
 import json
 import logging
+import math
 import os
 import progressbar
 import requests
 import sys
+import threading
+import zoneinfo
 from colorama import Fore
 from colorama import Style
+from ipl_file import append_journal
+from ipl_file import Row
+from ipl_file import IPL_VERSION
+from ipl_file import atomic_write
+from ipl_file import count_rows
+from ipl_file import fsync_dir
+from ipl_file import fold_cache
+from ipl_file import read_cache
+from ipl_file import read_header
+from ipl_file import read_journal
+from ipl_file import read_rows
+from ipl_file import replay_journal
+from ipl_file import title_store
+from ipl_file import update_manifest
+from ipl_file import write_rows
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import argparser
 from oauth2client.tools import run_flow
+from profiler import profiler
+from retry import CircuitBreaker
+from retry import CircuitOpenError
+from retry import RateLimiter
+from retry import RetryableError
+from retry import RetryPolicy
+from retry import call_with_retry
+from retry import parse_retry_after
 
 # Setup paths
 
@@ -23,51 +51,122 @@ src_dir = os.path.dirname(__file__)
 module_dir = os.path.join(src_dir, '..')
 config_path = os.path.join(module_dir, 'config/config-youtube.ini')
 
-# Setup logging
-
-timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-log_name = f"application-youtube-{timestamp}.log"
-log_path = os.path.join(module_dir, "logs")
-log_file = os.path.join(log_path, log_name)
-
-if not os.path.exists(log_path):
-    os.makedirs(log_path)
-
-logging.basicConfig(filename=log_file)
 log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
-
-# Setup CLI arguments and flags
-
-parser = argparse.ArgumentParser(description='Flags to change the running behavior of the youtube diff script.')
-parser.add_argument('-r', '--reauth', action='store_true', help='force the script to reauthenticate.')
-parser.add_argument('-s', '--showall', action='store_true', help='include items that are known to be renamed.')
-parser.add_argument('-v', '--verbose', action='store_true', help='output all verbose messages.')
-parser.add_argument('-c', '--config', help='run script using specific config file.')
-args = parser.parse_args()
-
-REAUTH_FLAG = args.reauth
-SHOW_ALL_FLAG = args.showall
-VERBOSE_FLAG = args.verbose
-config_path = args.config if args.config is not None else config_path
-
-log.info(f"Running with config file located at {config_path}.")
 
+API_URL = "https://www.googleapis.com/youtube/v3"
+CHECKPOINT_TTL = 60
+MAX_RESULTS = 50
 MISSING_FLAG = "!"
 PROGRESS_THRESHOLD = 100
+QUOTA_TIMEZONE = "America/Los_Angeles"
+REQUEST_TIMEOUT = 30
+RETRY_STATUSES = { 429, 500, 502, 503, 504 }
+
+# Only the parts of each response that are read below are requested, the
+# etag is kept so pages can still be fetched conditionally.
+
+TITLE_FIELDS = "items/snippet/title"
+PLAYLIST_FIELDS = "items(id,etag,snippet/title,contentDetails/itemCount)"
+PLAYLIST_ITEM_FIELDS = "etag,nextPageToken,pageInfo/totalResults,items(snippet(title,resourceId/videoId))"
+
+# Defaults, replaced by the CLI flags and config file in main()
+
+REAUTH_FLAG = False
+SHOW_ALL_FLAG = False
+VERBOSE_FLAG = False
+FULL_FLAG = False
+COMPACT_FLAG = False
+PROFILE_FLAG = False
+
+api_key = None
+api_url = API_URL
+path = "."
+client_secret = None
+playlists = []
+backups = 0
+storage = "csv"
+db_path = "playlists.db"
+journal = True
+compact_threshold = 1000
+precheck = True
+precheck_max_age = 24
+checkpoint_ttl = CHECKPOINT_TTL
+workers = 1
+quota = 10000
+priorities = {}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Flags to change the running behavior of the youtube diff script.')
+    parser.add_argument('-r', '--reauth', action='store_true', help='force the script to reauthenticate.')
+    parser.add_argument('-s', '--showall', action='store_true', help='include items that are known to be renamed.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='output all verbose messages.')
+    parser.add_argument('-c', '--config', help='run script using specific config file.')
+    parser.add_argument('-f', '--full', action='store_true', help='fetch every playlist even if its item count and etag are unchanged.')
+    parser.add_argument('-k', '--compact', action='store_true', help='fold every playlist journal, and .cache file of an earlier version, into its .ipl file.')
+    parser.add_argument('-w', '--workers', type=int, help='number of playlists to sync concurrently.')
+    parser.add_argument('--profile', action='store_true', help='print how long each part of the run took.')
+    parser.add_argument('--profile-output', help='also write the profile to a file.')
+    parser.add_argument('--profile-format', choices=['json', 'chrome'], default='json', help='format of the profile file, json or chrome trace.')
+
+    return parser.parse_args(argv)
+
+def setup_logging(verbose=False):
+    """Logs to one file per day, opened only once the first message is
+    written. Per-item debug messages are only logged with verbose output.
+    """
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d")
+    log_name = f"application-youtube-{timestamp}.log"
+    log_path = os.path.join(module_dir, "logs")
+    log_file = os.path.join(log_path, log_name)
 
-# Setup config
-
-config = configparser.ConfigParser()
-config.read(config_path)
-
-log.info(f"Reading in config file.")
+    if not os.path.exists(log_path):
+        os.makedirs(log_path)
 
-api_key = config.get('keys', 'api')
-path = config.get('params', 'path')
-client_secret = config.get('params', 'secret_path')
-playlists = json.loads(config.get('params', 'playlists'))
+    logging.basicConfig(handlers=[logging.FileHandler(log_file, delay=True)], format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
 
+def load_config(args):
+    """Sets the module flags and params from the CLI arguments and the
+    config file. Nothing is read or written when the module is imported,
+    so the fetch and diff functions can be used on their own.
+    """
+    global REAUTH_FLAG, SHOW_ALL_FLAG, VERBOSE_FLAG, FULL_FLAG, COMPACT_FLAG, PROFILE_FLAG
+    global config_path, api_key, api_url, path, client_secret, playlists, backups, storage
+    global db_path, journal, compact_threshold, precheck, precheck_max_age, checkpoint_ttl, workers, quota, priorities
+
+    REAUTH_FLAG = args.reauth
+    SHOW_ALL_FLAG = args.showall
+    VERBOSE_FLAG = args.verbose
+    FULL_FLAG = args.full
+    COMPACT_FLAG = args.compact
+    PROFILE_FLAG = args.profile or args.profile_output is not None
+    config_path = args.config if args.config is not None else config_path
+
+    log.info(f"Running with config file located at {config_path}.")
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    log.info(f"Reading in config file.")
+
+    api_key = config.get('keys', 'api')
+    api_url = config.get('params', 'api_url', fallback=API_URL)
+    path = config.get('params', 'path')
+    client_secret = config.get('params', 'secret_path')
+    playlists = json.loads(config.get('params', 'playlists'))
+    backups = config.getint('params', 'backups', fallback=0)
+    storage = config.get('params', 'storage', fallback='csv')
+    db_path = config.get('params', 'database', fallback=os.path.join(path, 'playlists.db'))
+    journal = config.getboolean('params', 'journal', fallback=True) and storage == "csv"
+    compact_threshold = config.getint('params', 'compact_threshold', fallback=1000)
+    precheck = config.getboolean('params', 'precheck', fallback=True) and not FULL_FLAG
+    precheck_max_age = config.getint('params', 'precheck_max_age', fallback=24)
+    checkpoint_ttl = config.getint('params', 'checkpoint_ttl', fallback=CHECKPOINT_TTL)
+    workers = args.workers if args.workers is not None else config.getint('params', 'workers', fallback=1)
+    quota = config.getint('params', 'quota', fallback=10000)
+    priorities = json.loads(config.get('params', 'priorities', fallback='{}'))
+
+@profiler.timed
 def auth():
     scope = ["https://www.googleapis.com/auth/youtube.readonly"]
     storage_path = os.path.join(module_dir, 'auth/credentials.storage')
@@ -104,82 +203,297 @@ def auth():
 
     return token
 
-def fetch_username(token):
-    url = "https://www.googleapis.com/youtube/v3/channels"
+class QuotaExceededError(Exception):
+    """Raised when the API refuses a request because the daily quota of
+    the api key has been used up."""
+
+class ApiClient:
+    """A client for the YouTube Data API v3.
+
+    Owns a pooled, keep-alive http session so every request made through
+    it reuses open connections to the API instead of doing a new TCP and
+    TLS handshake per page. The api key and the oauth2 token are attached
+    to every request here.
+
+    Parameters
+    ----------
+    key : str
+        The YouTube Data API v3 key.
+    token : str
+        The oauth2 access token, or None to only access public playlists.
+    pool_size : int
+        The number of connections kept open, should match the number of workers.
+    base_url : str
+        The url the API resources are requested from, changed to point the
+        client at a local mock of the API.
+
+    The number of requests made and response bytes received are counted,
+    so they can be reported at the end of a run. Every request made costs
+    one unit of the daily quota, including ones answered with 304.
+
+    Requests that fail with a dropped connection, a 5xx response or a
+    rate limit are retried with a jittered backoff. A Retry-After from
+    the API holds back every request made through the client, and after
+    too many failures in a row the client stops calling the API for a
+    while, raising CircuitOpenError.
+    """
+
+    def __init__(self, key, token=None, pool_size=1, base_url=API_URL):
+        self.key = key
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.requests = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self.policy = RetryPolicy()
+        self.limiter = RateLimiter()
+        self.breaker = CircuitBreaker()
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        if token is not None:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def get(self, resource, params, etag=None):
+        url = f"{self.base_url}/{resource}"
+        params = { "key": self.key, **params }
+        headers = { "If-None-Match": etag } if etag is not None else None
+
+        def attempt():
+            with profiler.span("api", resource=resource) as span:
+                try:
+                    res = self.session.get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    raise RetryableError(f"Could not connect requesting {resource}") from err
+                # Once the body is read, the raw stream has counted the
+                # bytes sent over the wire, before gzip was decoded.
+                res.content
+                received = res.raw.tell()
+                span.update(status=res.status_code, bytes=received)
+
+            with self.lock:
+                self.requests += 1
+                self.bytes_received += received
+
+            reasons = api_error_reasons(res) if res.status_code == 403 else set()
+
+            if reasons & { "quotaExceeded", "dailyLimitExceeded" }:
+                raise QuotaExceededError(f"Quota exceeded requesting {resource}")
+            if res.status_code in RETRY_STATUSES or reasons & { "rateLimitExceeded", "userRateLimitExceeded" }:
+                raise RetryableError(f"Status {res.status_code} requesting {resource}", parse_retry_after(res.headers.get("Retry-After")))
+
+            res.raise_for_status()
+
+            return res
+
+        return call_with_retry(attempt, self.policy, self.limiter, self.breaker)
+
+    def close(self):
+        self.session.close()
+
+def api_error_reasons(res):
+    try:
+        errors = res.json()["error"]["errors"]
+    except (ValueError, KeyError, TypeError):
+        return set()
+
+    return { e.get("reason") for e in errors }
+
+def api_error_message(res):
+    """Describes an error response by its status and reasons, such as
+    '403 playlistItemsNotAccessible'."""
+    reasons = sorted(reason for reason in api_error_reasons(res) if reason)
+    return " ".join([str(res.status_code), ", ".join(reasons)]).strip()
+
+@profiler.timed
+def fetch_username(client):
     params = {
-        "key": api_key,
         "mine": "true",
         "part": "snippet",
+        "fields": TITLE_FIELDS,
         "maxResults": "1"
     }
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    res = requests.get(url, params=params, headers=headers).json()
+    res = client.get("channels", params).json()
 
     return res["items"][0]["snippet"]["title"]
 
-def fetch_playlist_name(playlist_id, token=None):
-    url = "https://www.googleapis.com/youtube/v3/playlists"
+@profiler.timed
+def fetch_playlist_name(client, playlist_id):
     params = {
-        "key": api_key,
         "id": playlist_id,
         "part": "snippet",
+        "fields": TITLE_FIELDS,
         "maxResults": "1"
     }
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    if token == None:
-        res = requests.get(url, params=params).json()
-    else:
-        res = requests.get(url, params=params, headers=headers).json()
+    res = client.get("playlists", params).json()
 
     return res["items"][0]["snippet"]["title"]
 
-def fetch_playlist_page(playlist_id, token=None, page_token=None):
-    url = "https://www.googleapis.com/youtube/v3/playlistItems"
+@profiler.timed
+def fetch_playlist_details(client, playlist_ids):
+    """Fetches the title, item count and etag of many playlists, batching
+    up to MAX_RESULTS ids into each request.
+
+    Playlists that could not be accessed are left out of the result.
+
+    Returns
+    -------
+    dict
+        the playlist details, formatted as { playlist_id : { "title", "count", "etag" } }
+    """
+    ids = list(dict.fromkeys(playlist_ids))
+    details = {}
+
+    for i in range(0, len(ids), MAX_RESULTS):
+        params = {
+            "id": ",".join(ids[i:i + MAX_RESULTS]),
+            "part": "contentDetails,snippet",
+            "fields": PLAYLIST_FIELDS,
+            "maxResults": str(MAX_RESULTS)
+        }
+        res = client.get("playlists", params).json()
+
+        for item in res["items"]:
+            details[item["id"]] = {
+                "title": item["snippet"]["title"],
+                "count": item["contentDetails"]["itemCount"],
+                "etag": item["etag"]
+            }
+
+    print_verbose_and_log(f"Fetched details of {len(details)} of {len(ids)} playlist(s).")
+
+    return details
+
+@profiler.timed
+def fetch_playlist_page(client, playlist_id, page_token=None, etags=None):
     params = {
-        "key": api_key,
         "pageToken": page_token,
         "playlistId": playlist_id,
         "part": "snippet",
-        "maxResults": "50"
+        "fields": PLAYLIST_ITEM_FIELDS,
+        "maxResults": str(MAX_RESULTS)
     }
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    if token == None:
-        res = requests.get(url, params=params).json()
-    else:
-        res = requests.get(url, params=params, headers=headers).json()
+    key = page_token or ""
+    stored = etags.pages.get(key) if etags is not None else None
+    res = client.get("playlistItems", params, stored["etag"] if stored else None)
+
+    if res.status_code == 304:
+        items = etags.read_items(key)
+        etags.add(key, stored["etag"], items, stored["next"], stored["count"])
+        return (items, stored["next"], stored["count"], False)
 
-    items = { i["snippet"]["resourceId"]["videoId"]: i["snippet"]["title"] for i in res["items"] }
+    res = res.json()
+
+    items = { title_store.intern(i["snippet"]["resourceId"]["videoId"]): title_store.intern(i["snippet"]["title"]) for i in res["items"] }
     next_page = res["nextPageToken"] if "nextPageToken" in res else None
     count = res["pageInfo"]["totalResults"]
 
-    return (items, next_page, count)
+    if etags is not None:
+        etags.add(key, res["etag"], items, next_page, count)
 
-def fetch_playlist(playlist_id, token=None):
-    (fetched, next, count) = fetch_playlist_page(playlist_id, token)
+    return (items, next_page, count, True)
 
-    if count > PROGRESS_THRESHOLD:
-        progress = progressbar.ProgressBar(max_value=count)
+def iter_playlist_pages(client, playlist_id, show_progress=True, etags=None):
+    """Fetches the pages of a playlist one at a time, so each page can be
+    diffed as soon as it arrives instead of after the whole playlist.
 
-    while next != None:
-        if count > PROGRESS_THRESHOLD:
-            progress.update(len(fetched))
+    When etags is given, each page is requested with the ETag stored from
+    the last run and pages the API reports as not modified are read back
+    from the etag file. Once every page is visited the etags hold only
+    the visited pages, ready to be saved.
 
-        (items, next, count) = fetch_playlist_page(playlist_id, token, next)
-        fetched.update(items)
+    When checkpoints are on, each page is also appended to a checkpoint
+    file as it arrives, and pages left in the checkpoint by an interrupted
+    run are reused instead of being fetched again.
+
+    Yields
+    ------
+    tuple
+        the page token of each page, its items formatted as
+        { video_id : title }, and whether the page changed since the etags
+        were stored
+    """
+    if etags is not None:
+        etags.begin()
+
+    try:
+        resumed = read_checkpoint_file(playlist_id, etags) if checkpoint_ttl > 0 else {}
 
-    if count > PROGRESS_THRESHOLD:
-        progress.update(len(fetched))
-        progress.finish()
+        (items, next, total, modified) = fetch_checkpointed_page(client, playlist_id, "", etags, resumed)
+        fetched = len(items)
 
-    print_verbose_and_log(f"Fetched {len(fetched)} item(s) from playlist {playlist_id}")
+        show_progress = show_progress and total > PROGRESS_THRESHOLD
+        if show_progress:
+            progress = progressbar.ProgressBar(max_value=total)
 
-    return fetched
+        yield ("", items, modified)
+
+        while next != None:
+            if show_progress:
+                progress.update(min(fetched, total))
+
+            token = next
+            (items, next, _, modified) = fetch_checkpointed_page(client, playlist_id, token, etags, resumed)
+            fetched += len(items)
+
+            yield (token, items, modified)
+
+        if show_progress:
+            progress.update(total)
+            progress.finish()
+
+        print_verbose_and_log(f"Fetched {fetched} item(s) from playlist {playlist_id}")
+
+        if etags is not None:
+            # A page stored on the last run was not visited, so the playlist
+            # changed even if every visited page was not modified.
+            if etags.pages.keys() - etags.visited.keys():
+                yield (None, {}, True)
+            etags.end()
+    except BaseException:
+        if etags is not None:
+            etags.discard()
+        raise
+
+def fetch_checkpointed_page(client, playlist_id, page_token, etags, resumed):
+    """Takes a page from the checkpoint of an interrupted run if it is
+    there, otherwise fetches it and appends it to the checkpoint."""
+    if page_token in resumed:
+        page = resumed.pop(page_token)
+        items = page["items"] if "items" in page else etags.read_items(page_token)
+        if etags is not None and page["etag"] is not None:
+            etags.add(page_token, page["etag"], items, page["next"], page["count"])
+        return (items, page["next"], page["count"], page["modified"])
+
+    (items, next, count, modified) = fetch_playlist_page(client, playlist_id, page_token or None, etags)
+
+    if checkpoint_ttl > 0:
+        etag = etags.visited[page_token]["etag"] if etags is not None else None
+        append_checkpoint_file(playlist_id, page_token, etag, items, next, count, modified)
+
+    return (items, next, count, modified)
+
+def fetch_playlist(client, playlist_id, show_progress=True, etags=None):
+    """Fetches every page of a playlist.
+
+    Returns
+    -------
+    tuple
+        the fetched items formatted as { video_id : title }, and whether
+        any page changed since the etags were stored
+    """
+    fetched = {}
+    modified = False
+
+    for (_, items, page_modified) in iter_playlist_pages(client, playlist_id, show_progress, etags):
+        fetched.update(items)
+        modified = modified or page_modified
+
+    print_verbose_and_log(f"No page of playlist {playlist_id} was modified.", condition=not modified)
+
+    return (fetched, modified)
 
 def print_head_signin(username):
     p0 = f"{Style.RESET_ALL}{Fore.RED}👤{Style.RESET_ALL}"
@@ -198,6 +512,50 @@ def print_err_plnotfound(id):
     p2 = f"{Style.RESET_ALL}{Style.DIM}[{id}]{Style.RESET_ALL}"
     print(p0, p1, p2)
 
+def print_err_readfile(file):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Could not read file {Fore.RED}{file}{Style.RESET_ALL}, playlist was not updated"
+    print("  ", p0, p1)
+
+def print_err_compactfile(file):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Could not read file {Fore.RED}{file}{Style.RESET_ALL}, its journal was not compacted"
+    print(p0, p1)
+
+def print_err_fetch(message):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Could not fetch playlist, the API answered {Fore.RED}{message}{Style.RESET_ALL}, playlist was not updated"
+    print("  ", p0, p1)
+
+def print_err_readdb(db):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Could not read playlist from database {Fore.RED}{db}{Style.RESET_ALL}, playlist was not updated"
+    print("  ", p0, p1)
+
+def print_warn_deferred(id, title):
+    p0 = f"{Style.RESET_ALL}{Fore.YELLOW}▶{Style.RESET_ALL}"
+    p1 = "{:60}".format(f"{Style.RESET_ALL}Deferred {Fore.YELLOW}{title}{Style.RESET_ALL} playlist to the next run.")
+    p2 = f"{Style.RESET_ALL}{Style.DIM}[{id}]{Style.RESET_ALL}"
+    print(p0, p1, p2)
+
+def print_warn_oversized(id, title):
+    p0 = f"{Style.RESET_ALL}{Fore.YELLOW}▶{Style.RESET_ALL}"
+    p1 = "{:60}".format(f"{Style.RESET_ALL}Skipped {Fore.YELLOW}{title}{Style.RESET_ALL} playlist, it could use more than the daily quota of {quota} unit(s).")
+    p2 = f"{Style.RESET_ALL}{Style.DIM}[{id}]{Style.RESET_ALL}"
+    print(p0, p1, p2)
+
+def print_err_quota(used):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}The API quota is used up after {Fore.RED}{used}{Style.RESET_ALL} unit(s) today, remaining playlists will be synced on the next run"
+    print(p0, p1)
+    print()
+
+def print_err_unavailable():
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.RED}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}The API stopped responding after several retries, remaining playlists will be synced on the next run"
+    print(p0, p1)
+    print()
+
 def print_info_added(id, title):
     p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.GREEN}+{Style.RESET_ALL}"
     p1 = f"{Style.RESET_ALL}New song {Fore.GREEN}{title}{Style.RESET_ALL} found"
@@ -240,26 +598,67 @@ def print_warn_writingfile(file):
     p1 = f"{Style.RESET_ALL}Writing to file {Fore.YELLOW}{file}{Style.RESET_ALL}"
     print("  ", p0, p1)
 
-def print_verbose_and_log(msg, condition=True, error=None):
+def print_warn_dbnotfound(db):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.YELLOW}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Could not find playlist in database {Fore.YELLOW}{db}{Style.RESET_ALL}"
+    print("  ", p0, p1)
+
+def print_warn_createdb(db):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.YELLOW}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Adding new playlist to database {Fore.YELLOW}{db}{Style.RESET_ALL}"
+    print("  ", p0, p1)
+
+def print_warn_writingdb(db):
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.YELLOW}!{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Writing to database {Fore.YELLOW}{db}{Style.RESET_ALL}"
+    print("  ", p0, p1)
+
+def print_verbose_and_log(msg, *args, condition=True, error=None):
+    """Logs a message and prints it when verbose output is on.
+
+    The message may be a %-style format string, in which case it is only
+    formatted with args if it is printed or written to the log.
+    """
     if condition and error:
-        log.error(msg)
+        log.error(msg, *args)
         log.exception(error)
     elif condition:
-        log.info(msg)
+        log.info(msg, *args)
 
     if not VERBOSE_FLAG or not condition:
         return
 
     p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.WHITE}»{Style.RESET_ALL}"
-    p1 = f"{Style.RESET_ALL}{msg}"
+    p1 = f"{Style.RESET_ALL}{msg % args if args else msg}"
+    print(p0, p1)
+
+def print_verbose_item(msg, *args):
+    """Logs and prints a message about a single item at debug level.
+
+    Used from the per-item diff loops, which also check VERBOSE_FLAG
+    before calling, so nothing is formatted, logged or even called for
+    each item unless verbose output is on.
+    """
+    if not VERBOSE_FLAG:
+        return
+
+    log.debug(msg, *args)
+
+    p0 = f"{Style.RESET_ALL}{Style.BRIGHT}{Fore.WHITE}»{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}{msg % args}"
     print(p0, p1)
 
 def is_empty(list):
     return len(list) == 0
 
+@profiler.timed
 def read_cache_file(playlist_id):
     """Reads in a file of song ids that are known to be renamed.
 
+    The file was written by versions before 1.3, which store the renames
+    in the .ipl file instead. It is read until the playlist is next
+    written, then removed.
+
     If there is no file, or the file is empty, the function
     will return an empty set.
 
@@ -275,41 +674,429 @@ def read_cache_file(playlist_id):
         print_verbose_and_log(f"Could not find {sname} file.'")
         return {}
 
-    with open(spath, 'r') as file:
-        reader = csv.reader(file)
-        ids = {line[0]: line[1] for line in reader}
+    ids = read_cache(spath)
 
     print_verbose_and_log(f"Read {len(ids)} row(s) from '{sname}'")
 
     return ids
 
-def write_cache_file(cache, playlist_id):
-    """Writes in a file of song ids that are known to be renamed.
+def fold_cache_file(rows, playlist_id):
+    """Sets the renames of a '.cache' file left by a version before 1.3 on
+    the rows of the playlist, if there is one."""
+    if os.path.exists(os.path.join(path, f".{playlist_id}.cache")):
+        fold_cache(rows, read_cache_file(playlist_id))
+
+def remove_cache_file(playlist_id):
+    spath = os.path.join(path, f".{playlist_id}.cache")
+    if os.path.exists(spath):
+        print_verbose_and_log(f"Removing '.{playlist_id}.cache', its renames are now stored with the playlist.")
+        os.remove(spath)
+
+class PageEtags:
+    """The ETags and pages returned for a playlist on the last run, stored
+    in the '.{playlist}.etag' file with one page on each line.
 
-    If there is no file, a file '.{playlist}.cache' will be created in the project
-    root directory.
+    Only the etag, next page token and item count of each page are held
+    in memory, with where its line starts in the file. The items of a
+    page are read back from the file when the page is reused, and each
+    page visited is appended to a new file as it arrives, which replaces
+    the old one when saved. So the items of the whole playlist are never
+    held at once.
 
     Parameters
+    ----------
+    fpath : str
+        The etag file, which does not need to exist.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.source = fpath
+        self.pages = {}
+        self.visited = None
+        self.staged = None
+        self.staged_path = None
+        self.generation = 0
+
+    def load(self):
+        """Reads in the etags of each page stored in the file. A file written
+        by an earlier version, which holds every page in one object, is
+        rewritten with one page on each line first."""
+        with open(self.fpath, 'rb') as file:
+            first = json.loads(file.readline() or "{}")
+
+        if "pages" in first:
+            with atomic_write(self.fpath) as file:
+                for (token, page) in first["pages"].items():
+                    file.write(page_line(token, page["etag"], page["items"], page["next"], page["count"]))
+
+        offset = 0
+        with open(self.fpath, 'rb') as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                page = json.loads(line)
+                self.pages[page["token"]] = { "etag": page["etag"], "next": page["next"], "count": page["count"], "offset": offset }
+                offset += len(line)
+
+    def read_items(self, token):
+        """Reads back the items of a stored page, formatted as { video_id : title }."""
+        with open(self.source, 'rb') as file:
+            file.seek(self.pages[token]["offset"])
+            items = json.loads(file.readline())["items"]
+
+        intern = title_store.intern
+        return { intern(id): intern(title) for (id, title) in items.items() }
+
+    def begin(self):
+        """Starts a new file for the pages visited by a fetch. It is named
+        the same way as the temporary files of atomic_write, and created
+        with the same permissions as the other files written."""
+        (dir, name) = os.path.split(self.fpath)
+        self.generation += 1
+        self.staged_path = os.path.join(dir, f".{name}.{os.getpid()}-{threading.get_ident()}-{self.generation}.tmp")
+        self.staged = open(self.staged_path, 'wb')
+        self.visited = {}
+
+    def add(self, token, etag, items, next, count):
+        """Appends a visited page to the new file."""
+        offset = self.staged.tell()
+        self.staged.write(page_line(token, etag, items, next, count).encode())
+        self.visited[token] = { "etag": etag, "next": next, "count": count, "offset": offset }
+
+    def end(self):
+        """Finishes the new file, the visited pages replace the stored pages
+        but the etag file is only replaced by save."""
+        self.staged.flush()
+        os.fsync(self.staged.fileno())
+        self.staged.close()
+
+        if self.source != self.fpath:
+            os.remove(self.source)
+
+        (self.source, self.pages) = (self.staged_path, self.visited)
+        (self.staged, self.staged_path, self.visited) = (None, None, None)
+
+    def save(self):
+        if self.source == self.fpath:
+            return
+
+        os.replace(self.source, self.fpath)
+        fsync_dir(os.path.dirname(self.fpath))
+        self.source = self.fpath
+
+    def discard(self):
+        """Removes the new file of a fetch that did not finish, or was not
+        saved. The etags are not used again after."""
+        if self.staged is not None:
+            self.staged.close()
+            os.remove(self.staged_path)
+            (self.staged, self.staged_path) = (None, None)
+        if self.source != self.fpath:
+            os.remove(self.source)
+            self.source = self.fpath
+
+def page_line(token, etag, items, next, count):
+    return json.dumps({ "token": token, "etag": etag, "next": next, "count": count, "items": items }) + "\n"
+
+@profiler.timed
+def read_etag_file(playlist_id):
+    """Reads in the ETags of the pages returned for a playlist on the last
+    run, the items of each page are left in the file until needed.
+
+    If there is no file, or it cannot be read, the function will return
+    etags without any pages.
+
+    Returns
     -------
-    map
-        a map of all the known song ids formatted as { id : title }
+    PageEtags
+        the stored etags
     """
-    spath = os.path.join(path, f".{playlist_id}.cache")
-    rows = [[id, title] for id, title in cache.items()]
+    ename = f".{playlist_id}.etag"
+    etags = PageEtags(os.path.join(path, ename))
 
-    print_verbose_and_log(f"Writing {len(cache)} row(s) to '.{playlist_id}.cache'")
-    with open(spath, 'w+') as file:
-        writer = csv.writer(file)
-        for item in rows:
-            writer.writerow(item)
+    if not os.path.exists(etags.fpath):
+        print_verbose_and_log(f"Could not find {ename} file.")
+        return etags
+
+    try:
+        etags.load()
+    except Exception as err:
+        print_verbose_and_log(f"Error occured while reading etag file for {playlist_id}.", error=err)
+        return PageEtags(etags.fpath)
+
+    print_verbose_and_log(f"Read {len(etags.pages)} page etag(s) from '{ename}'")
+
+    return etags
+
+@profiler.timed
+def write_etag_file(etags, playlist_id):
+    """Replaces the '.{playlist}.etag' file with the pages visited by the
+    last fetch, so the next run can make conditional requests."""
+    print_verbose_and_log(f"Writing {len(etags.pages)} page etag(s) to '.{playlist_id}.etag'")
+    etags.save()
+
+def read_checkpoint_file(playlist_id, etags=None):
+    """Reads in the pages fetched by an interrupted run of a playlist.
+
+    The first line of the file holds the time the checkpoint was started,
+    a checkpoint older than checkpoint_ttl minutes is removed and ignored.
+    Every other line holds one page. Pages that were not modified since
+    the etags were stored only keep their etag, and their items are read
+    from the etags when the page is used, so a page missing from both is
+    left out.
+
+    Returns
+    -------
+    dict
+        the pages, formatted as
+        { page_token : { "etag", "items", "next", "count", "modified" } }
+        where items is left out of pages that were not modified
+    """
+    cname = f".{playlist_id}.checkpoint"
+    cpath = os.path.join(path, cname)
+
+    if not os.path.exists(cpath):
+        return {}
+
+    with open(cpath, 'r') as file:
+        content = file.read()
+
+    try:
+        lines = [json.loads(line) for line in content[:content.rfind("\n") + 1].splitlines()]
+        created = datetime.datetime.fromisoformat(lines[0]["created"])
+    except Exception as err:
+        print_verbose_and_log(f"Error occured while reading checkpoint file for {playlist_id}.", error=err)
+        os.remove(cpath)
+        return {}
+
+    if datetime.datetime.now() - created > datetime.timedelta(minutes=checkpoint_ttl):
+        print_verbose_and_log(f"Removing expired '{cname}' started at {created}.")
+        os.remove(cpath)
+        return {}
+
+    pages = {}
+    stored = etags.pages if etags is not None else {}
+
+    for page in lines[1:]:
+        if "items" not in page and (page["token"] not in stored or stored[page["token"]]["etag"] != page["etag"]):
+            continue
+        pages[page.pop("token")] = page
+
+    print_verbose_and_log(f"Resuming {len(pages)} page(s) of playlist {playlist_id} from '{cname}'")
+
+    return pages
+
+def append_checkpoint_file(playlist_id, page_token, etag, items, next, count, modified):
+    """Appends a fetched page to the '.{playlist}.checkpoint' file, starting
+    the file if needed. Items are left out of pages that were not
+    modified, they are already stored with the etags."""
+    cpath = os.path.join(path, f".{playlist_id}.checkpoint")
+    page = { "token": page_token, "etag": etag, "next": next, "count": count, "modified": modified }
+
+    if modified or etag is None:
+        page["items"] = items
+
+    with open(cpath, 'a') as file:
+        if file.tell() == 0:
+            file.write(json.dumps({ "created": datetime.datetime.now().isoformat() }) + "\n")
+        file.write(json.dumps(page) + "\n")
+        file.flush()
+
+def remove_checkpoint_file(playlist_id):
+    cpath = os.path.join(path, f".{playlist_id}.checkpoint")
+
+    if os.path.exists(cpath):
+        os.remove(cpath)
+
+def quota_date():
+    """The daily quota of the YouTube Data API resets at midnight Pacific
+    time, so the units used are tracked per Pacific date."""
+    return datetime.datetime.now(zoneinfo.ZoneInfo(QUOTA_TIMEZONE)).strftime("%Y-%m-%d")
+
+@profiler.timed
+def read_schedule_file():
+    """Reads in a file of the quota units used today and the time each
+    playlist was last synced.
+
+    If there is no file, or it was written on an earlier quota day, no
+    units are counted as used.
+
+    Returns
+    -------
+    dict
+        the schedule, formatted as
+        { "date" : str, "used" : int, "synced" : { playlist_id : timestamp },
+          "walked" : { playlist_id : timestamp } }
+        where walked is the last time every page of a playlist was fetched
+    """
+    spath = os.path.join(path, ".schedule")
+    schedule = { "date": quota_date(), "used": 0, "synced": {}, "walked": {} }
+
+    if not os.path.exists(spath):
+        print_verbose_and_log("Could not find .schedule file.")
+        return schedule
+
+    try:
+        with open(spath, 'r') as file:
+            stored = json.load(file)
+    except Exception as err:
+        print_verbose_and_log("Error occured while reading schedule file.", error=err)
+        return schedule
 
+    schedule["synced"] = stored.get("synced", {})
+    schedule["walked"] = stored.get("walked", {})
+    if stored.get("date") == schedule["date"]:
+        schedule["used"] = stored.get("used", 0)
+
+    print_verbose_and_log(f"{schedule['used']} of {quota} quota unit(s) already used today.")
+
+    return schedule
+
+@profiler.timed
+def write_schedule_file(schedule):
+    spath = os.path.join(path, ".schedule")
+
+    print_verbose_and_log(f"Writing {schedule['used']} used quota unit(s) to '.schedule'")
+    with atomic_write(spath) as file:
+        json.dump(schedule, file)
+
+def is_walk_due(schedule, playlist):
+    """Checks whether every page of a playlist must be fetched even if the
+    precheck would skip it.
+
+    The etag of a playlist only changes with its title and description,
+    not with its items, and a video that is deleted or made private keeps
+    its place in the item count. So the precheck is only trusted for
+    precheck_max_age hours after the playlist was last walked in full.
+    """
+    walked = schedule.get("walked", {}).get(playlist)
+    if walked is None:
+        return True
+
+    return datetime.datetime.now() - datetime.datetime.fromisoformat(walked) >= datetime.timedelta(hours=precheck_max_age)
+
+def estimate_quota(playlist, details, walk=False):
+    """Estimates the most quota units syncing a playlist can use, one per
+    page, or none if the precheck will skip it."""
+    if details is None:
+        return 0
+
+    if precheck and not walk:
+        header = read_playlist_header(playlist)
+        if header is not None and header[6:8] == [str(details["count"]), details["etag"]]:
+            return 0
+
+    return max(1, math.ceil(details["count"] / MAX_RESULTS))
+
+def schedule_playlists(playlist_ids, details, schedule, used):
+    """Orders the playlists by priority, then by how long ago they were
+    last synced, and picks the ones that can be synced within the quota.
+
+    A playlist that could use more units than are left is deferred and the
+    ones after it are still considered, so one large playlist does not hold
+    back the rest. Deferred playlists are the least recently synced on the
+    next run, so they are synced first. A playlist that could use more than
+    the whole quota is never synced.
+
+    Parameters
+    ----------
+    details : dict
+        The playlist details from fetch_playlist_details.
+    schedule : dict
+        The schedule from read_schedule_file.
+    used : int
+        The units used today, including this run so far.
+
+    Returns
+    -------
+    tuple
+        the playlist ids to sync, the playlist ids deferred and the playlist
+        ids larger than the quota, in order
+    """
+    synced = schedule["synced"]
+    ordered = sorted(dict.fromkeys(playlist_ids), key=lambda id: (-priorities.get(id, 0), synced.get(id, "")))
+    (scheduled, deferred, oversized) = ([], [], [])
+
+    for playlist in ordered:
+        cost = estimate_quota(playlist, details.get(playlist), is_walk_due(schedule, playlist))
+        if cost > quota:
+            print_verbose_and_log(f"Playlist {playlist} could use {cost} unit(s), more than the quota of {quota}.")
+            oversized.append(playlist)
+        elif used + cost > quota:
+            print_verbose_and_log(f"Playlist {playlist} could use {cost} unit(s) but {quota - used} are left, deferring it.")
+            deferred.append(playlist)
+        else:
+            used += cost
+            scheduled.append(playlist)
+
+    return (scheduled, deferred, oversized)
+
+@profiler.timed
+def read_playlist_header(playlist_id):
+    """Reads in only the header row of a playlist file.
+
+    Returns
+    -------
+    list
+        the header formatted as
+        [file_type, version_id, playlist_origin, count, playlist_id, name, item_count, etag]
+        or None if the file could not be read. Files before version 1.2
+        have no item_count and etag.
+    """
+    if storage == "sqlite":
+        return ipl_sqlite.read_header(db_path, playlist_id)
+
+    fpath = os.path.join(path, f"{playlist_id}.ipl")
+
+    if not os.path.exists(fpath):
+        return None
+
+    return read_header(fpath, os.path.join(path, f".{playlist_id}.journal"))
+
+@profiler.timed
+def check_playlist_file(playlist_id):
+    """Checks that the .ipl file of a playlist holds as many rows as its
+    header count, by counting its lines instead of parsing them. A sync
+    with no changed page never reads the file, so this is how a truncated
+    file is found then.
+
+    Raises
+    ------
+    ValueError
+        when the file holds fewer or more rows than its header count
+    """
+    if storage == "sqlite":
+        return
+
+    fname = f"{playlist_id}.ipl"
+    fpath = os.path.join(path, fname)
+
+    if not os.path.exists(fpath):
+        return
+
+    with open(fpath, 'r') as file:
+        header = next(csv.reader(file), None)
+
+    rows = count_rows(fpath)
+    if header is None or int(header[3]) != rows:
+        raise ValueError(f"'{fname}' has {rows} row(s) but its header expects {header[3] if header else 'a header'}, the file may be truncated.")
+
+@profiler.timed
 def read_playlist_file(playlist_id):
     """Reads in a csv file of playlist information.
 
-    If there is no file, or the file is empty, the function
-    will return an empty list.The header of the file is 
-    always the first row and formatted as:
-    #file_type, version_id, playlist_origin, count, playlist_id
+    If there is no file the function will return an empty list. The
+    header of the file is always the first row and formatted as:
+    #file_type, version_id, playlist_origin, count, playlist_id, name, item_count, etag
+
+    Changes appended to the playlist journal since the file was last
+    written are replayed on top of it, and the renames of a '.cache' file
+    left by an earlier version are set on the rows.
+
+    A file that exists but cannot be parsed, or holds fewer rows than
+    its header count, raises an error instead of being treated as empty,
+    so a damaged file is never reported as a playlist of new items.
 
     Parameters
     ----------
@@ -321,34 +1108,56 @@ def read_playlist_file(playlist_id):
     list
         a list of all the song items, formatted as [flag, video_id, title]
     """
-    try:
-        fpath = os.path.join(path, f"{playlist_id}.ipl")
+    if storage == "sqlite":
+        items = ipl_sqlite.read_playlist(db_path, playlist_id)
+        print_verbose_and_log(f"Read {len(items)} row(s) for '{playlist_id}' from '{db_path}'")
+    else:
+        fname = f"{playlist_id}.ipl"
+        fpath = os.path.join(path, fname)
+
+        if not os.path.exists(fpath):
+            print_verbose_and_log(f"Could not find {fname} file.")
+            return []
 
         with open(fpath, 'r') as file:
             reader = csv.reader(file)
-            next(reader)
-            items = [row for row in reader]
+            header = next(reader)
+            items = read_rows(reader)
 
-        print_verbose_and_log(f"Read {len(items)} row(s) from '{playlist_id}.ipl'")
+        if int(header[3]) != len(items):
+            raise ValueError(f"'{fname}' has {len(items)} row(s) but its header expects {header[3]}, the file may be truncated.")
 
-        if VERBOSE_FLAG:
-            missing = 0
-            for item in items:
-                if item[0] == MISSING_FLAG:
-                    missing += 1
-            print_verbose_and_log(f"{missing} item(s) already marked as missing.")
+        print_verbose_and_log(f"Read {len(items)} row(s) from '{fname}'")
 
-        return items
-    except Exception as err:
-        print_verbose_and_log(f"Error occured while reading playlist file for {playlist_id}.", error=err)
-        return []
+        jname = f".{playlist_id}.journal"
+        events = read_journal(os.path.join(path, jname))
+        if not is_empty(events):
+            items = replay_journal(items, events)
+            print_verbose_and_log(f"Replayed {len(events)} event(s) from '{jname}'")
 
-def write_playlist_file(rows, playlist_id, name):
+    fold_cache_file(items, playlist_id)
+
+    if VERBOSE_FLAG:
+        missing = 0
+        for item in items:
+            if item[0] == MISSING_FLAG:
+                missing += 1
+        print_verbose_and_log(f"{missing} item(s) already marked as missing.")
+
+    profiler.record(rows=len(items))
+
+    return items
+
+@profiler.timed
+def write_playlist_file(rows, playlist_id, name, item_count="", etag=""):
     """Writes in a csv file the playlist information and songs.
 
     If there is no file, the function will create a new file. The
     header of the file is always the first row and formatted as:
-    #file_type, version_id, playlist_origin, count, playlist_id
+    #file_type, version_id, playlist_origin, count, playlist_id, name, item_count, etag
+
+    Each song row is formatted as flag, video_id, title, rename, where
+    rename is the latest title of a song renamed since it was stored.
 
     Parameters
     ----------
@@ -356,17 +1165,86 @@ def write_playlist_file(rows, playlist_id, name):
         The songs to write to the file, formatted as: [flag, video_id, title]
     playlist_id : str
         The playlist id, used to find the csv file on disk.
+    name : str
+        The playlist title.
+    item_count : int
+        The item count reported by the API when the playlist was fetched.
+    etag : str
+        The playlist etag reported by the API when the playlist was fetched.
     """
+    profiler.record(written=len(rows))
+
+    if storage == "sqlite":
+        print_verbose_and_log(f"Writing {len(rows)} row(s) for '{playlist_id}' to '{db_path}'")
+        ipl_sqlite.write_playlist(db_path, rows, playlist_id, "YOUTUBE", name, item_count, etag)
+        return
+
     fpath = os.path.join(path, f"{playlist_id}.ipl")
-    header = ["#IPL", "1.1", "YOUTUBE", len(rows), playlist_id, name]
+    header = ["#IPL", IPL_VERSION, "YOUTUBE", len(rows), playlist_id, name, item_count, etag]
 
     print_verbose_and_log(f"Writing {len(rows)} row(s) to '{playlist_id}.ipl'")
-    with open(fpath, 'w+') as file:
+    with atomic_write(fpath, backups) as file:
         writer = csv.writer(file)
         writer.writerow(header)
-        for row in rows:
-            writer.writerow(row)
+        write_rows(writer, rows)
+
+    update_manifest(path, playlist_id, name, rows)
 
+@profiler.timed
+def append_journal_file(events, playlist_id):
+    """Appends change events to the '.{playlist}.journal' file, instead of
+    rewriting the whole .ipl file.
+
+    Parameters
+    ----------
+    events : list
+        the events to append, formatted as (event, video_id, title)
+    playlist_id : str
+        The playlist id, used to find the journal file on disk.
+    """
+    jname = f".{playlist_id}.journal"
+
+    print_verbose_and_log(f"Appending {len(events)} event(s) to '{jname}'")
+    profiler.record(written=len(events))
+    append_journal(os.path.join(path, jname), events)
+
+def count_journal_file(playlist_id):
+    return len(read_journal(os.path.join(path, f".{playlist_id}.journal")))
+
+@profiler.timed
+def compact_playlist_file(playlist_id, rows=None, name=None, item_count="", etag=""):
+    """Folds the journal of a playlist, and a '.cache' file left by an
+    earlier version, into its .ipl file and removes them. When rows is
+    None the playlist is read back from disk first, and a file that
+    cannot be read is reported and left as it is.
+    """
+    jpath = os.path.join(path, f".{playlist_id}.journal")
+    spath = os.path.join(path, f".{playlist_id}.cache")
+
+    if not os.path.exists(jpath) and not os.path.exists(spath):
+        return
+    if not os.path.exists(os.path.join(path, f"{playlist_id}.ipl")):
+        return
+
+    if rows is None:
+        try:
+            header = read_playlist_header(playlist_id)
+            header = header + [""] * (8 - len(header))
+            rows = read_playlist_file(playlist_id)
+        except Exception as err:
+            print_verbose_and_log(f"Could not read stored items of playlist {playlist_id}, skipping compaction.", error=err)
+            print_err_compactfile(f"{playlist_id}.ipl")
+            return
+        (name, item_count, etag) = (header[5], header[6], header[7])
+
+    print_verbose_and_log(f"Compacting journal of '{playlist_id}.ipl'")
+    write_playlist_file(rows, playlist_id, name, item_count, etag)
+    if os.path.exists(jpath):
+        os.remove(jpath)
+    remove_cache_file(playlist_id)
+    update_manifest(path, playlist_id, name, rows)
+
+@profiler.timed
 def find_added_items(master, new_items):
     """Compares the items from the new_items list and master list,
     and finds all the added items.
@@ -383,21 +1261,22 @@ def find_added_items(master, new_items):
     list
         a list of all the added songs, formatted as (video_id, title)
     """
+    verbose = VERBOSE_FLAG
     added = []
-    index = 0
-    old_items = { i[1]: i for i in master }
+    old_items = { i[1] for i in master }
     for id, title in new_items.items():
         if id not in old_items:
-            print_verbose_and_log(f"Found unrecognized id {id} - {title}")
+            if verbose:
+                print_verbose_item("Found unrecognized id %s - %s", id, title)
             added.append((id, title))
-            master.insert(index, ["", id, title])
-            index += 1
 
-    print_verbose_and_log("No unrecognized ids found. ", condition=is_empty(added))
-    print_verbose_and_log(f"{len(added)} unrecognized id(s) found. ", condition=not is_empty(added))
+    master[:] = [Row("", id, title) for (id, title) in added] + master
+
+    print_verbose_and_log("%d unrecognized id(s) found.", len(added))
 
     return added
 
+@profiler.timed
 def find_recovered_items(master, new_items):
     """Compares the items from the new_items list and master list,
     and finds all ids present in new_items that were previously marked as missing.
@@ -414,18 +1293,20 @@ def find_recovered_items(master, new_items):
     list
         a list of all the recovered songs, formatted as (video_id, title)
     """
+    verbose = VERBOSE_FLAG
     recovered = []
     for i, [flag, id, title] in enumerate(master):
         if id in new_items and flag == MISSING_FLAG:
-            print_verbose_and_log(f"Found recovered id {id} - {title}")
+            if verbose:
+                print_verbose_item("Found recovered id %s - %s", id, title)
             recovered.append((id, title))
-            master[i] = ["", id, title]
+            master[i] = Row("", id, title)
 
-    print_verbose_and_log("No recovered ids found. ", condition=is_empty(recovered))
-    print_verbose_and_log(f"{len(recovered)} recovered id(s) found. ", condition=not is_empty(recovered))
+    print_verbose_and_log("%d recovered id(s) found.", len(recovered))
 
     return recovered
 
+@profiler.timed
 def find_missing_items(master, new_items):
     """Compares the items from the new_items list and master list,
     and finds all the missing items.
@@ -442,18 +1323,20 @@ def find_missing_items(master, new_items):
     list
         a list of all the missing songs, formatted as (video_id, title)
     """
+    verbose = VERBOSE_FLAG
     missing = []
     for i, [flag, id, title] in enumerate(master):
         if id not in new_items and flag != MISSING_FLAG:
-            print_verbose_and_log(f"Found missing id at position {i}, {master[i]}")
+            if verbose:
+                print_verbose_item("Found missing id at position %d, %s", i, master[i])
             master[i][0] = MISSING_FLAG
             missing.append((id, title))
 
-    print_verbose_and_log("No missing ids found. ", condition=is_empty(missing))
-    print_verbose_and_log(f"{len(missing)} missing id(s) found. ", condition=not is_empty(missing))
+    print_verbose_and_log("%d missing id(s) found.", len(missing))
 
     return missing
 
+@profiler.timed
 def find_renamed_items(master, new_items):
     """Compares the items from the new_items list and master list,
     and finds all the renamed items.
@@ -470,95 +1353,533 @@ def find_renamed_items(master, new_items):
     list
         a list of all the renamed songs, formatted as (video_id, old_title, new_title)
     """
+    verbose = VERBOSE_FLAG
     renamed = []
     for [_, id, title] in master:
         if id in new_items and title != new_items[id]:
-            print_verbose_and_log(f"Found renamed item {id}, {title} > {new_items[id]}")
+            if verbose:
+                print_verbose_item("Found renamed item %s, %s > %s", id, title, new_items[id])
             renamed.append((id, title, new_items[id]))
 
-    print_verbose_and_log("No renamed items found. ", condition=is_empty(renamed))
-    print_verbose_and_log(f"{len(renamed)} renamed item(s) found.", condition=not is_empty(renamed))
+    print_verbose_and_log("%d renamed item(s) found.", len(renamed))
 
     return renamed
 
-def main():
-    token = auth()
-    user = fetch_username(token)
-    print_head_signin(user)
-    print()
+class PlaylistDiff:
+    """Diffs the pages of a playlist against the stored items as they are
+    fetched, finding all the added, recovered, missing and renamed items.
 
-    for playlist in playlists:
-        try:
-            name = fetch_playlist_name(playlist, token)
-            print_head_fetching(playlist, name)
-        except Exception as err:
-            print_verbose_and_log(f"Playlist {playlist} not found.", error=err)
-            print_err_plnotfound(playlist)
-            continue
+    Added, recovered and renamed items are found as each page is passed
+    to update. Missing items can only be known once every page has been
+    seen, so they are found by finish, which also updates the master list
+    the same way as diff_playlist.
 
-        master = read_playlist_file(playlist)
-        cache = read_cache_file(playlist)
-        new = fetch_playlist(playlist, token)
+    Parameters
+    ----------
+    master : list
+        list of all items, formatted as [flag, video_id, title]
+    """
 
-        fname = f"{playlist}.ipl"
-        fpath = os.path.join(path, fname)
-        if not os.path.exists(fpath):
-            print_warn_filenotfound(fname)
+    def __init__(self, master):
+        self.master = master
+        self.positions = { row[1]: i for i, row in enumerate(master) }
+        self.seen = set()
+        self.added = []
+        self.recovered = []
+        self.renamed = []
+
+    @profiler.timed
+    def update(self, items):
+        """Diffs one page of fetched items, formatted as { video_id : title }."""
+        verbose = VERBOSE_FLAG
+        master = self.master
+        positions = self.positions
+        seen = self.seen
+
+        for id, title in items.items():
+            if id in seen:
+                continue
+            seen.add(id)
+
+            i = positions.get(id)
+            if i is None:
+                if verbose:
+                    print_verbose_item("Found unrecognized id %s - %s", id, title)
+                self.added.append((id, title))
+                continue
+
+            row = master[i]
+            if row[0] == MISSING_FLAG:
+                if verbose:
+                    print_verbose_item("Found recovered id %s - %s", id, row[2])
+                self.recovered.append((i, (id, row[2])))
+                row[0] = ""
+            if row[2] != title:
+                if verbose:
+                    print_verbose_item("Found renamed item %s, %s > %s", id, row[2], title)
+                self.renamed.append((i, (id, row[2], title)))
+
+    @profiler.timed
+    def finish(self):
+        """Finds the missing items and adds the new items to the front of
+        the master list.
+
+        Returns
+        -------
+        tuple
+            the added, recovered and missing songs, formatted as (video_id, title),
+            and the renamed songs, formatted as (video_id, old_title, new_title)
+        """
+        verbose = VERBOSE_FLAG
+        master = self.master
+        seen = self.seen
+        missing = []
+
+        for i, row in enumerate(master):
+            if row[1] not in seen and row[0] != MISSING_FLAG:
+                if verbose:
+                    print_verbose_item("Found missing id at position %d, %s", i, row)
+                missing.append((row[1], row[2]))
+                row[0] = MISSING_FLAG
+
+        # Pages arrive in playlist order, the stored items are reported in
+        # master order the same as the find_* functions.
+        recovered = [item for (_, item) in sorted(self.recovered, key=lambda x: x[0])]
+        renamed = [item for (_, item) in sorted(self.renamed, key=lambda x: x[0])]
+        added = self.added
+
+        master[:] = [Row("", id, title) for (id, title) in added] + master
+
+        print_verbose_and_log("%d unrecognized, %d recovered, %d missing and %d renamed item(s) found.",
+            len(added), len(recovered), len(missing), len(renamed))
+
+        return (added, recovered, missing, renamed)
+
+@profiler.timed
+def diff_playlist(master, new_items):
+    """Compares the items from the new_items list and master list in a
+    single pass, and finds all the added, recovered, missing and renamed items.
+
+    The master list is updated the same way as calling find_added_items,
+    find_recovered_items, find_missing_items and find_renamed_items in
+    that order, but it is walked once and rebuilt once.
+
+    Parameters
+    ----------
+    master : list
+        list of all items, formatted as [flag, video_id, title]
+    new_items : dict
+        list of new items, formatted as { video_id : title }
 
-        added = find_added_items(master, new)
-        recovered = find_recovered_items(master, new)
-        missing = find_missing_items(master, new)
-        renamed = find_renamed_items(master, new)
-
-        for item in added:
-            id = item[0]
-            title = item[1]
-            print_info_added(id, title)
-
-        for item in recovered:
-            id = item[0]
-            title = item[1]
-            print_info_recovered(id, title)
-
-        for item in missing:
-            id = item[0]
-            title = item[1]
-            print_info_missing(id, title)
-
-        for item in renamed:
-            id = item[0]
-            old_title = item[1]
-            new_title = item[2]
-            if id not in cache or cache[id] != new_title or SHOW_ALL_FLAG:
-                print_info_rename(id, old_title, new_title)
-
-        cache_flag = False
-        for item in renamed:
-            id = item[0]
-            new_title = item[2]
-            cache_flag = cache_flag \
-                or id not in cache \
-                or cache[id] != new_title
-            cache[id] = new_title
-
-        sname = f".{playlist}.cache"
-        spath = os.path.join(path, sname)
-        if cache_flag:
-            if not os.path.exists(spath):
-                print_warn_filenotfound(sname)
-            print_warn_writingfile(sname)
-            write_cache_file(cache, playlist)
-
-        if not is_empty(added) or not is_empty(missing) or not is_empty(recovered):
-            if not os.path.exists(fpath):
-                print_warn_createfile(fname)
-            print_warn_writingfile(fname)
-            write_playlist_file(master, playlist, name)
-
-        elif is_empty(renamed) or not cache_flag:
-            print_info_nochanges()
+    Returns
+    -------
+    tuple
+        the added, recovered and missing songs, formatted as (video_id, title),
+        and the renamed songs, formatted as (video_id, old_title, new_title)
+    """
+    differ = PlaylistDiff(master)
+    differ.update(new_items)
+
+    return differ.finish()
+
+def unchanged_result(result):
+    result.update({
+        "added": [],
+        "recovered": [],
+        "missing": [],
+        "renamed": [],
+        "new_renamed": [],
+        "renames_changed": False,
+        "changed": False
+    })
+    return result
+
+def sync_playlist(client, playlist, details, show_progress=True, walk=False):
+    """Fetches a playlist, diffs it against the stored items and writes
+    any changes back to the .ipl file.
+
+    Nothing is printed apart from verbose messages, so several playlists
+    can be synced at once and reported afterwards in order.
+
+    Parameters
+    ----------
+    client : ApiClient
+        The client used to make requests to the YouTube Data API.
+    playlist : str
+        The playlist id to sync.
+    details : dict
+        The playlist details from fetch_playlist_details, or None if the
+        playlist could not be accessed.
+    show_progress : bool
+        Whether to draw a progress bar while fetching large playlists.
+    walk : bool
+        Whether to fetch the pages even if the precheck would skip them.
+
+    Returns
+    -------
+    dict
+        the outcome of the sync, passed to print_sync_result
+    """
+    result = { "playlist": playlist, "name": None, "read_error": False, "journaled": False, "walked": False }
+
+    if details is None:
+        print_verbose_and_log(f"Playlist {playlist} not found.")
+        return result
+
+    result["name"] = details["title"]
+
+    spath = os.path.join(path, f".{playlist}.cache")
+    header = read_playlist_header(playlist)
+
+    result["file_existed"] = header is not None
+    result["cache_existed"] = os.path.exists(spath)
+
+    header_stale = header is None or header[6:8] != [str(details["count"]), details["etag"]]
+
+    try:
+        check_playlist_file(playlist)
+    except ValueError as err:
+        print_verbose_and_log(f"Could not read stored items of playlist {playlist}, skipping.", error=err)
+        result["read_error"] = True
+        return result
+
+    if precheck and not walk and not header_stale:
+        print_verbose_and_log(f"Skipping fetch, playlist {playlist} item count and etag are unchanged.")
+        return unchanged_result(result)
+
+    # Pages are diffed as they arrive. The stored items are only read once
+    # a page has changed, the unchanged pages before it are read back from
+    # the etag file then instead of being held.
+    etags = read_etag_file(playlist)
+    differ = None
+    pending = []
+
+    for (token, items, modified) in iter_playlist_pages(client, playlist, show_progress, etags):
+        if differ is None and (modified or header_stale):
+            try:
+                master = read_playlist_file(playlist)
+            except Exception as err:
+                print_verbose_and_log(f"Could not read stored items of playlist {playlist}, skipping.", error=err)
+                result["read_error"] = True
+                etags.discard()
+                return result
+
+            differ = PlaylistDiff(master)
+            for page_token in pending:
+                differ.update(etags.read_items(page_token))
+            pending = None
+
+        if differ is None:
+            pending.append(token)
+        else:
+            differ.update(items)
+
+    result["walked"] = True
+
+    if differ is None:
+        print_verbose_and_log(f"Skipping diff, playlist {playlist} is unchanged since the last run.")
+        write_etag_file(etags, playlist)
+        remove_checkpoint_file(playlist)
+        return unchanged_result(result)
+
+    (added, recovered, missing, renamed) = differ.finish()
+
+    # The latest title of each renamed song is kept on its row, so a
+    # rename is only reported and stored when it differs from that.
+    renamed_rows = {}
+    if not is_empty(renamed):
+        renamed_ids = { item[0] for item in renamed }
+        renamed_rows = { row[1]: row for row in master if row[1] in renamed_ids }
+
+    new_renamed = []
+    events = []
+    for item in renamed:
+        id = item[0]
+        new_title = item[2]
+        row = renamed_rows[id]
+        if row.rename != new_title:
+            new_renamed.append(item)
+            events.append(("rename", id, new_title))
+            row.rename = new_title
+
+    renames_changed = not is_empty(events)
+    folded = result["cache_existed"]
+
+    changed = not is_empty(added) or not is_empty(missing) or not is_empty(recovered)
+    if (changed or header_stale or renames_changed or folded) and storage == "sqlite":
+        if folded:
+            print_verbose_and_log(f"Writing {len(master)} row(s) for '{playlist}' to '{db_path}'")
+            with profiler.span("write_playlist", written=len(master)):
+                ipl_sqlite.write_playlist(db_path, master, playlist, "YOUTUBE", result["name"], details["count"], details["etag"])
+        else:
+            print_verbose_and_log(f"Updating {len(added) + len(recovered) + len(missing) + len(events)} row(s) for '{playlist}' in '{db_path}'")
+            with profiler.span("update_playlist", written=len(added) + len(recovered) + len(missing) + len(events)):
+                ipl_sqlite.update_playlist(db_path, playlist, "YOUTUBE", result["name"], details["count"], details["etag"],
+                    added, recovered, missing, [(id, title) for (_, id, title) in events])
+    elif journal and result["file_existed"] and not folded and (changed or header_stale or renames_changed):
+        events = [("add", id, title) for (id, title) in added] \
+            + [("recover", id, title) for (id, title) in recovered] \
+            + [("missing", id, title) for (id, title) in missing] \
+            + events \
+            + [("header", details["count"], details["etag"])]
+        append_journal_file(events, playlist)
+        update_manifest(path, playlist, result["name"], master)
+        result["journaled"] = True
+
+        if count_journal_file(playlist) >= compact_threshold:
+            compact_playlist_file(playlist, master, result["name"], details["count"], details["etag"])
+    elif folded and result["file_existed"]:
+        compact_playlist_file(playlist, master, result["name"], details["count"], details["etag"])
+    elif changed or header_stale or renames_changed:
+        write_playlist_file(master, playlist, result["name"], details["count"], details["etag"])
+
+    if folded:
+        remove_cache_file(playlist)
+
+    write_etag_file(etags, playlist)
+    remove_checkpoint_file(playlist)
+
+    result.update({
+        "added": added,
+        "recovered": recovered,
+        "missing": missing,
+        "renamed": renamed,
+        "new_renamed": new_renamed,
+        "renames_changed": renames_changed,
+        "changed": changed
+    })
+
+    return result
+
+def deferred_result(playlist, details, oversized=False):
+    return { "playlist": playlist, "name": details["title"] if details else None, "deferred": True, "oversized": oversized }
+
+def failed_result(playlist, details, err):
+    return { "playlist": playlist, "name": details["title"] if details else None, "fetch_error": api_error_message(err.response) }
+
+def print_sync_result(result):
+    playlist = result["playlist"]
+    name = result["name"]
+
+    if result.get("oversized"):
+        print_warn_oversized(playlist, name or "Unknown")
+        return
+
+    if result.get("deferred"):
+        print_warn_deferred(playlist, name or "Unknown")
+        return
 
+    if result.get("fetch_error") is not None:
+        print_head_fetching(playlist, name or "Unknown")
+        print_err_fetch(result["fetch_error"])
         print()
+        return
+
+    if name is None:
+        print_err_plnotfound(playlist)
+        return
+
+    print_head_fetching(playlist, name)
+
+    fname = f"{playlist}.ipl"
+    dbname = os.path.basename(db_path)
+
+    if result["read_error"]:
+        if storage == "sqlite":
+            print_err_readdb(dbname)
+        else:
+            print_err_readfile(fname)
+        print()
+        return
+
+    if not result["file_existed"]:
+        if storage == "sqlite":
+            print_warn_dbnotfound(dbname)
+        else:
+            print_warn_filenotfound(fname)
+
+    for item in result["added"]:
+        id = item[0]
+        title = item[1]
+        print_info_added(id, title)
+
+    for item in result["recovered"]:
+        id = item[0]
+        title = item[1]
+        print_info_recovered(id, title)
+
+    for item in result["missing"]:
+        id = item[0]
+        title = item[1]
+        print_info_missing(id, title)
+
+    # A rename found in several playlists is shown under the first one
+    # reported, results are printed in config order so that does not
+    # depend on which worker finished first.
+    for item in result["renamed"] if SHOW_ALL_FLAG else result["new_renamed"]:
+        id = item[0]
+        old_title = item[1]
+        new_title = item[2]
+        if SHOW_ALL_FLAG or title_store.first_rename(id, new_title):
+            print_info_rename(id, old_title, new_title)
+
+    if (result["changed"] or result["renames_changed"]) and storage == "sqlite":
+        if not result["file_existed"]:
+            print_warn_createdb(dbname)
+        print_warn_writingdb(dbname)
+    elif result["changed"] or result["renames_changed"]:
+        if not result["file_existed"]:
+            print_warn_createfile(fname)
+        print_warn_writingfile(f".{playlist}.journal" if result["journaled"] else fname)
+    else:
+        print_info_nochanges()
+
+    print()
+
+def print_profile_stats(label, stats):
+    p0 = "{:44}".format(f"{Style.RESET_ALL}{Fore.CYAN}{label}{Style.RESET_ALL}")
+    p1 = f"{stats['wall']:8.3f}s {stats['api_calls']:5} call(s) {stats['bytes'] / 1024:10.1f} KB {stats['rows']:8} row(s)"
+    print("  ", p0, p1)
+
+    for (name, span) in sorted(stats["spans"].items(), key=lambda item: -item[1]["time"]):
+        p2 = f"{Style.RESET_ALL}{Style.DIM}{name:36} {span['count']:6}x {span['time']:8.3f}s{Style.RESET_ALL}"
+        print("      ", p2)
+
+def print_profile(summary, names):
+    p0 = f"{Style.RESET_ALL}{Fore.CYAN}⏱{Style.RESET_ALL}"
+    p1 = f"{Style.RESET_ALL}Profile of this run, span times include the spans inside them"
+    print(p0, p1)
+
+    for (playlist, stats) in summary["playlists"].items():
+        print_profile_stats(names.get(playlist) or playlist, stats)
+
+    print_profile_stats("Total", summary["total"])
+    print()
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.verbose)
+    load_config(args)
+
+    profiler.enabled = PROFILE_FLAG
+    title_store.clear()
+
+    schedule = read_schedule_file()
+    quota_exceeded = threading.Event()
+    api_unavailable = threading.Event()
+
+    # Fetching the username and the playlist details, 50 at a time, comes
+    # before any playlist is scheduled, so it must fit in what is left.
+    if schedule["used"] + 1 + math.ceil(len(set(playlists)) / MAX_RESULTS) > quota:
+        print_verbose_and_log(f"{quota - schedule['used']} unit(s) are left, too few to fetch the playlist details.")
+        print_err_quota(schedule["used"])
+        return
+
+    token = auth()
+    client = ApiClient(api_key, token, pool_size=workers, base_url=api_url)
+
+    try:
+        user = fetch_username(client)
+        details = fetch_playlist_details(client, playlists)
+    except QuotaExceededError as err:
+        print_verbose_and_log("Quota exceeded before any playlist was synced.", error=err)
+        schedule["used"] = max(schedule["used"] + client.requests, quota)
+        write_schedule_file(schedule)
+        print_err_quota(schedule["used"])
+        client.close()
+        return
+    except (RetryableError, CircuitOpenError) as err:
+        print_verbose_and_log("The API is unavailable before any playlist was synced.", error=err)
+        schedule["used"] += client.requests
+        write_schedule_file(schedule)
+        print_err_unavailable()
+        client.close()
+        return
+
+    print_head_signin(user)
+    print()
+
+    (scheduled, deferred, oversized) = schedule_playlists(playlists, details, schedule, schedule["used"] + client.requests)
+
+    def sync(playlist, show_progress):
+        if quota_exceeded.is_set() or api_unavailable.is_set():
+            return deferred_result(playlist, details.get(playlist))
+
+        with profiler.span("sync_playlist", playlist=playlist):
+            try:
+                result = sync_playlist(client, playlist, details.get(playlist), show_progress, is_walk_due(schedule, playlist))
+            except QuotaExceededError as err:
+                print_verbose_and_log(f"Quota exceeded syncing playlist {playlist}.", error=err)
+                quota_exceeded.set()
+                return deferred_result(playlist, details.get(playlist))
+            except (RetryableError, CircuitOpenError) as err:
+                print_verbose_and_log(f"The API is unavailable syncing playlist {playlist}.", error=err)
+                api_unavailable.set()
+                return deferred_result(playlist, details.get(playlist))
+            except requests.HTTPError as err:
+                print_verbose_and_log(f"Could not fetch playlist {playlist}.", error=err)
+                return failed_result(playlist, details.get(playlist), err)
+
+        if result["name"] is not None and not result["read_error"]:
+            schedule["synced"][playlist] = datetime.datetime.now().isoformat()
+        if result["walked"]:
+            schedule["walked"][playlist] = schedule["synced"][playlist]
+
+        return result
+
+    # The schedule only picks which playlists are synced and in what order,
+    # results are printed in the order of the config file, each as soon as
+    # every result before it is in.
+    order = list(dict.fromkeys(playlists))
+    results = { playlist: deferred_result(playlist, details.get(playlist)) for playlist in deferred }
+    results.update({ playlist: deferred_result(playlist, details.get(playlist), oversized=True) for playlist in oversized })
+
+    def report_ready():
+        while order and order[0] in results:
+            result = results.pop(order.pop(0))
+            with profiler.span("print_sync_result", playlist=result["playlist"]):
+                print_sync_result(result)
+
+    report_ready()
+
+    if workers <= 1:
+        for playlist in scheduled:
+            results[playlist] = sync(playlist, True)
+            report_ready()
+    else:
+        print_verbose_and_log(f"Syncing {len(scheduled)} playlist(s) with {workers} workers.")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = { executor.submit(sync, playlist, False): playlist for playlist in scheduled }
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+                report_ready()
+
+    schedule["used"] += client.requests
+    if quota_exceeded.is_set():
+        schedule["used"] = max(schedule["used"], quota)
+        print_err_quota(schedule["used"])
+    elif api_unavailable.is_set():
+        print_err_unavailable()
+
+    write_schedule_file(schedule)
+
+    if COMPACT_FLAG and storage != "sqlite":
+        for playlist in playlists:
+            compact_playlist_file(playlist)
+
+    print_verbose_and_log("Received %d byte(s) in %d request(s).", client.bytes_received, client.requests)
+    client.close()
+
+    if PROFILE_FLAG:
+        print_profile(profiler.summary(), { id: d["title"] for (id, d) in details.items() })
+
+    if args.profile_output is not None:
+        if args.profile_format == "chrome":
+            profiler.write_chrome_trace(args.profile_output)
+        else:
+            profiler.write_json(args.profile_output)
+        print_verbose_and_log(f"Wrote profile to '{args.profile_output}'")
 
     log.info("Script exited successfully.")
 
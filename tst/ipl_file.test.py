@@ -0,0 +1,306 @@
+import csv
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+tst_dir = os.path.dirname(__file__)
+src_dir = os.path.join(tst_dir, '../src')
+sys.path.append(src_dir)
+
+from ipl_file import Row
+from ipl_file import TitleStore
+from ipl_file import append_journal
+from ipl_file import atomic_write
+from ipl_file import is_manifest_current
+from ipl_file import count_rows
+from ipl_file import iter_playlist_file
+from ipl_file import iter_playlist_journal
+from ipl_file import read_header
+from ipl_file import read_journal
+from ipl_file import read_manifest
+from ipl_file import replay_journal
+from ipl_file import replay_journal_header
+from ipl_file import update_manifest
+
+class TestIplFile(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fpath = os.path.join(self.dir.name, "PL0.ipl")
+        with open(self.fpath, 'w') as file:
+            file.write("old")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self, fpath):
+        with open(fpath, 'r') as file:
+            return file.read()
+
+    #
+    # atomic_write
+    #
+
+    def test_atomic_write(self):
+        with atomic_write(self.fpath) as file:
+            file.write("new")
+
+        self.assertEqual("new", self.read(self.fpath))
+        self.assertEqual(["PL0.ipl"], os.listdir(self.dir.name))
+
+    def test_atomic_write_error(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with atomic_write(self.fpath) as file:
+                file.write("partial")
+                raise KeyboardInterrupt()
+
+        self.assertEqual("old", self.read(self.fpath))
+        self.assertEqual(["PL0.ipl"], os.listdir(self.dir.name))
+
+    def test_atomic_write_backups(self):
+        for content in ["new 1", "new 2", "new 3"]:
+            with atomic_write(self.fpath, backups=2) as file:
+                file.write(content)
+
+        self.assertEqual("new 3", self.read(self.fpath))
+        self.assertEqual("new 2", self.read(f"{self.fpath}.1"))
+        self.assertEqual("new 1", self.read(f"{self.fpath}.2"))
+        self.assertFalse(os.path.exists(f"{self.fpath}.3"))
+
+    #
+    # replay_journal
+    #
+
+    def test_replay_journal(self):
+        expected = [
+            ["", "00000000004", "Item 4"],
+            ["", "00000000002", "Item 2"],
+            ["", "00000000003", "Item 3"],
+            ["!", "00000000000", "Item 0"],
+            ["", "00000000001", "Item 1"]
+        ]
+        rows = [
+            Row("", "00000000000", "Item 0"),
+            Row("!", "00000000001", "Item 1")
+        ]
+        journal = [
+            ["t0", "add", "00000000002", "Item 2"],
+            ["t0", "add", "00000000003", "Item 3"],
+            ["t0", "missing", "00000000000", "Item 0"],
+            ["t1", "add", "00000000004", "Item 4"],
+            ["t1", "recover", "00000000001", "Item 1"],
+            ["t1", "rename", "00000000001", "Item 1 (New)"]
+        ]
+        actual = replay_journal(rows, journal)
+
+        self.assertEqual(expected, actual)
+        self.assertEqual("Item 1 (New)", actual[4].rename)
+
+    def test_replay_journal_twice(self):
+        expected = [
+            ["", "00000000002", "Item 2"],
+            ["!", "00000000000", "Item 0"]
+        ]
+        journal = [
+            ["t0", "add", "00000000002", "Item 2"],
+            ["t0", "missing", "00000000000", "Item 0"]
+        ]
+        rows = replay_journal([["", "00000000000", "Item 0"]], journal)
+        actual = replay_journal(rows, journal)
+
+        self.assertEqual(expected, actual)
+
+    def test_replay_journal_header(self):
+        expected = ["#IPL", "1.2", "YOUTUBE", "3", "PL0", "Playlist", "2", "etag 1"]
+        header = ["#IPL", "1.2", "YOUTUBE", "2", "PL0", "Playlist", "", ""]
+        journal = [
+            ["t0", "add", "00000000002", "Item 2"],
+            ["t0", "header", "2", "etag 0"],
+            ["t1", "header", "2", "etag 1"]
+        ]
+        actual = replay_journal_header(header, journal)
+
+        self.assertEqual(expected, actual)
+
+    def test_replay_journal_header_present(self):
+        header = ["#IPL", "1.3", "YOUTUBE", "2", "PL0", "Playlist", "2", "etag"]
+        journal = [
+            ["t0", "add", "00000000001", "Item 1"],
+            ["t0", "add", "00000000002", "Item 2"],
+            ["t1", "add", "00000000002", "Item 2"]
+        ]
+        actual = replay_journal_header(header, journal, { "00000000000", "00000000001" })
+
+        self.assertEqual("3", actual[3])
+
+    #
+    # read_journal
+    #
+
+    def test_read_journal_partial_line(self):
+        jpath = os.path.join(self.dir.name, ".PL0.journal")
+        append_journal(jpath, [("add", "00000000002", "Item 2")])
+        with open(jpath, 'a') as file:
+            file.write("2020-01-01T00:00:00,add,00000000003,It")
+        actual = read_journal(jpath)
+
+        self.assertEqual(1, len(actual))
+        self.assertEqual(["add", "00000000002", "Item 2"], actual[0][1:])
+
+    #
+    # read_header
+    #
+
+    def test_read_header(self):
+        with open(self.fpath, 'w') as file:
+            file.write("#IPL,1.2,YOUTUBE,1,PL0,Playlist,1,etag\n,00000000000,Item 0\n")
+        append_journal(os.path.join(self.dir.name, ".PL0.journal"), [("add", "00000000001", "Item 1")])
+        actual = read_header(self.fpath, os.path.join(self.dir.name, ".PL0.journal"))
+
+        self.assertEqual(["#IPL", "1.2", "YOUTUBE", "2", "PL0", "Playlist", "1", "etag"], actual)
+
+    def test_read_header_compacted(self):
+        with open(self.fpath, 'w') as file:
+            file.write("#IPL,1.3,YOUTUBE,2,PL0,Playlist,2,etag\n,00000000001,Item 1,\n!,00000000000,Item 0,\n")
+        append_journal(os.path.join(self.dir.name, ".PL0.journal"), [("add", "00000000001", "Item 1")])
+        actual = read_header(self.fpath, os.path.join(self.dir.name, ".PL0.journal"))
+
+        self.assertEqual("2", actual[3])
+
+    #
+    # iter_playlist_file
+    #
+
+    def test_iter_playlist_file(self):
+        with open(self.fpath, 'w') as file:
+            file.write('#IPL,1.2,YOUTUBE,3,PL0,Playlist\n,00000000000,Item 0\n!,00000000001,"Item, 1"\n,00000000002,"!,2"\n')
+        rows = iter_playlist_file(self.fpath)
+
+        self.assertEqual("PL0", next(rows)[4])
+        self.assertEqual([["", "00000000000", "Item 0"], ["!", "00000000001", "Item, 1"], ["", "00000000002", "!,2"]], list(rows))
+
+    def test_iter_playlist_file_missing_only(self):
+        with open(self.fpath, 'w') as file:
+            file.write('#IPL,1.2,YOUTUBE,3,PL0,Playlist\n,00000000000,Item 0\n!,00000000001,"Item, 1"\n,00000000002,"!,2"\n!,00000000003,Item 3')
+        rows = list(iter_playlist_file(self.fpath, missing_only=True))[1:]
+
+        self.assertEqual([["!", "00000000001", "Item, 1"], ["!", "00000000003", "Item 3"]], rows)
+
+    #
+    # count_rows
+    #
+
+    def test_count_rows(self):
+        with open(self.fpath, 'w') as file:
+            file.write('#IPL,1.3,YOUTUBE,3,PL0,Playlist\n,00000000000,Item 0,\n!,00000000001,"Item, 1",\n,00000000002,Item 2,')
+
+        self.assertEqual(3, count_rows(self.fpath))
+
+    #
+    # iter_playlist_journal
+    #
+
+    def write_journaled(self):
+        with open(self.fpath, 'w') as file:
+            file.write("#IPL,1.3,YOUTUBE,3,PL0,Playlist,3,etag\n,00000000000,Item 0,\n!,00000000001,Item 1,\n!,00000000002,Item 2,\n")
+        return [
+            ["t0", "add", "00000000003", "Item 3"],
+            ["t0", "missing", "00000000000", "Item 0"],
+            ["t1", "add", "00000000004", "Item 4"],
+            ["t1", "recover", "00000000001", "Item 1"],
+            ["t1", "rename", "00000000001", "Item 1 (New)"],
+            ["t1", "missing", "00000000003", "Item 3"],
+            ["t1", "header", "4", "etag 1"]
+        ]
+
+    def test_iter_playlist_journal(self):
+        journal = self.write_journaled()
+        rows = list(iter_playlist_file(self.fpath))
+        expected = replay_journal(rows[1:], journal)
+        actual = list(iter_playlist_journal(self.fpath, journal))
+
+        self.assertEqual(replay_journal_header(rows[0], journal), actual[0])
+        self.assertEqual(expected, actual[1:])
+        self.assertEqual([row.rename for row in expected], [row.rename for row in actual[1:]])
+
+    def test_iter_playlist_journal_missing_only(self):
+        expected = [["!", "00000000003", "Item 3"], ["!", "00000000000", "Item 0"], ["!", "00000000002", "Item 2"]]
+        journal = self.write_journaled()
+        actual = list(iter_playlist_journal(self.fpath, journal, missing_only=True))[1:]
+
+        self.assertEqual(expected, actual)
+
+    def test_iter_playlist_journal_compacted(self):
+        journal = [["t0", "add", "00000000003", "Item 3"]]
+        with open(self.fpath, 'w') as file:
+            file.write("#IPL,1.3,YOUTUBE,2,PL0,Playlist,2,etag\n,00000000003,Item 3,\n,00000000000,Item 0,\n")
+        actual = list(iter_playlist_journal(self.fpath, journal))
+
+        self.assertEqual("2", actual[0][3])
+        self.assertEqual([["", "00000000003", "Item 3"], ["", "00000000000", "Item 0"]], actual[1:])
+
+    #
+    # manifest
+    #
+
+    def test_update_manifest(self):
+        rows = [Row("", "00000000000", "Item 0"), Row("!", "00000000001", "Item 1")]
+        update_manifest(self.dir.name, "PL0", "Playlist", rows)
+        entry = read_manifest(self.dir.name)["PL0"]
+
+        self.assertEqual(("Playlist", 2, 1), (entry["name"], entry["count"], entry["missing"]))
+        self.assertTrue(is_manifest_current(self.dir.name, "PL0", entry))
+
+    def test_update_manifest_stale(self):
+        update_manifest(self.dir.name, "PL0", "Playlist", [])
+        append_journal(os.path.join(self.dir.name, ".PL0.journal"), [("add", "00000000000", "Item 0")])
+        entry = read_manifest(self.dir.name)["PL0"]
+
+        self.assertFalse(is_manifest_current(self.dir.name, "PL0", entry))
+
+    #
+    # Row
+    #
+
+    def test_row(self):
+        row = Row("", "00000000000", "Item 0")
+        row[0] = "!"
+        [flag, id, title] = row
+
+        self.assertEqual(["!", "00000000000", "Item 0"], row)
+        self.assertEqual(("!", "00000000000", "Item 0"), (flag, id, title))
+        self.assertEqual("Item 0", row[-1])
+
+    def test_row_csv(self):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(Row("!", "00000000000", "Item, 0"))
+
+        self.assertEqual('!,00000000000,"Item, 0"\r\n', buffer.getvalue())
+
+    #
+    # TitleStore
+    #
+
+    def test_title_store_row(self):
+        store = TitleStore()
+        first = store.row("", "00000000000", "".join(["Item ", "0"]))
+        second = store.row("!", "".join(["0000000000", "0"]), "".join(["Item", " 0"]))
+
+        self.assertIs(first.id, second.id)
+        self.assertIs(first.title, second.title)
+
+    def test_title_store_first_rename(self):
+        store = TitleStore()
+
+        self.assertTrue(store.first_rename("00000000000", "Item 0 (Remastered)"))
+        self.assertFalse(store.first_rename("00000000000", "Item 0 (Remastered)"))
+        self.assertTrue(store.first_rename("00000000000", "Item 0 (Live)"))
+
+if __name__=='__main__':
+    unittest.main()
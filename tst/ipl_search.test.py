@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import unittest
+
+tst_dir = os.path.dirname(__file__)
+src_dir = os.path.join(tst_dir, '../src')
+sys.path.append(src_dir)
+
+import ipl_search
+from ipl_file import append_journal
+from ipl_search import connect
+from ipl_search import search
+from ipl_search import update_index
+
+class TestIplSearch(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        ipl_search.path = self.dir.name
+        ipl_search.storage = "csv"
+        self.index_path = os.path.join(self.dir.name, ".search.db")
+
+        self.write("PL0", [["", "00000000000", "Artist - First Song"], ["!", "00000000001", "Artist - Second Song"]])
+        self.write("PL1", [["", "00000000001", "Artist - Second Song"], ["", "00000000002", "Other - Third"]])
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, playlist_id, rows):
+        with open(os.path.join(self.dir.name, f"{playlist_id}.ipl"), 'w') as file:
+            file.write(f"#IPL,1.2,YOUTUBE,{len(rows)},{playlist_id},Playlist {playlist_id},,\n")
+            for row in rows:
+                file.write(",".join(row) + "\n")
+
+    def search(self, *args, **kwargs):
+        with connect(self.index_path) as conn:
+            update_index(conn)
+            return search(conn, *args, **kwargs)
+
+    #
+    # search
+    #
+
+    def test_search_id(self):
+        actual = self.search(["00000000001"])
+
+        self.assertEqual(["PL0", "PL1"], [row[0] for row in actual])
+        self.assertEqual(("Playlist PL0", "!"), actual[0][1:3])
+
+    def test_search_id_prefix(self):
+        actual = self.search(["0000000000*"])
+
+        self.assertEqual(4, len(actual))
+
+    def test_search_title(self):
+        actual = self.search(text="artist sec")
+
+        self.assertEqual([("PL0", "00000000001"), ("PL1", "00000000001")], [(row[0], row[3]) for row in actual])
+
+    def test_search_title_missing_only(self):
+        actual = self.search(text="song", missing_only=True)
+
+        self.assertEqual([("PL0", "00000000001")], [(row[0], row[3]) for row in actual])
+
+    #
+    # update_index
+    #
+
+    def test_update_index(self):
+        with connect(self.index_path) as conn:
+            self.assertEqual(2, update_index(conn))
+            self.assertEqual(0, update_index(conn))
+
+        append_journal(os.path.join(self.dir.name, ".PL1.journal"), [("add", "00000000003", "Artist - Fourth")])
+        os.remove(os.path.join(self.dir.name, "PL0.ipl"))
+
+        with connect(self.index_path) as conn:
+            self.assertEqual(1, update_index(conn))
+            actual = search(conn, text="artist")
+
+        self.assertEqual(["00000000003", "00000000001"], [row[3] for row in actual])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+tst_dir = os.path.dirname(__file__)
+src_dir = os.path.join(tst_dir, '../src')
+sys.path.append(src_dir)
+
+from ipl_sqlite import iter_playlist
+from ipl_sqlite import read_header
+from ipl_sqlite import read_playlist
+from ipl_sqlite import write_playlist
+from ipl_sqlite import update_playlist
+from ipl_sqlite import import_ipl_file
+from ipl_sqlite import export_ipl_file
+from ipl_file import append_journal
+from ipl_file import is_manifest_current
+from ipl_file import iter_playlist_file
+from ipl_file import read_header as read_header_file
+from ipl_file import read_manifest
+
+class TestIplSqlite(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.dir.name, "playlists.db")
+        self.rows = [
+            ["", "00000000000", "Item 0"],
+            ["", "00000000001", "Item 1"],
+            ["!", "00000000002", "Item 2"]
+        ]
+        write_playlist(self.db_path, self.rows, "PL0", "YOUTUBE", "Playlist", 2, "etag")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    #
+    # read_header
+    #
+
+    def test_read_header(self):
+        expected = ["#IPL", "1.3", "YOUTUBE", "3", "PL0", "Playlist", "2", "etag"]
+        actual = read_header(self.db_path, "PL0")
+
+        self.assertEqual(expected, actual)
+
+    def test_read_header_unknown(self):
+        actual = read_header(self.db_path, "PL1")
+
+        self.assertIsNone(actual)
+
+    #
+    # read_playlist
+    #
+
+    def test_read_playlist(self):
+        actual = read_playlist(self.db_path, "PL0")
+
+        self.assertEqual(self.rows, actual)
+
+    def test_read_playlist_unknown(self):
+        actual = read_playlist(self.db_path, "PL1")
+
+        self.assertEqual([], actual)
+
+    def test_iter_playlist_missing_only(self):
+        actual = list(iter_playlist(self.db_path, "PL0", missing_only=True))
+
+        self.assertEqual([self.rows[2]], actual)
+
+    def test_read_playlist_shared_titles(self):
+        rows = [["", "00000000000", "Item 0 (Remastered)"], ["", "00000000001", "Item 1"]]
+        write_playlist(self.db_path, rows, "PL1", "YOUTUBE", "Playlist", 2, "etag")
+
+        self.assertEqual(self.rows, read_playlist(self.db_path, "PL0"))
+        self.assertEqual(rows, read_playlist(self.db_path, "PL1"))
+
+    def test_read_playlist_migrated(self):
+        db_path = os.path.join(self.dir.name, "old.db")
+        conn = sqlite3.connect(db_path)
+        conn.executescript("""
+            CREATE TABLE playlists (playlist_id TEXT PRIMARY KEY, origin TEXT NOT NULL, name TEXT NOT NULL, item_count INTEGER, etag TEXT);
+            CREATE TABLE items (playlist_id TEXT NOT NULL, video_id TEXT NOT NULL, flag TEXT NOT NULL, title TEXT NOT NULL, position INTEGER NOT NULL, PRIMARY KEY (playlist_id, video_id));
+            INSERT INTO playlists VALUES ('PL0', 'YOUTUBE', 'Playlist', 2, 'etag');
+            INSERT INTO items VALUES ('PL0', '00000000000', '', 'Item 0', 0), ('PL0', '00000000001', '!', 'Item 1', 1);
+        """)
+        conn.close()
+
+        actual = read_playlist(db_path, "PL0")
+
+        self.assertEqual([["", "00000000000", "Item 0"], ["!", "00000000001", "Item 1"]], actual)
+
+    #
+    # update_playlist
+    #
+
+    def test_update_playlist(self):
+        expected = [
+            ["", "00000000003", "Item 3"],
+            ["", "00000000004", "Item 4"],
+            ["!", "00000000000", "Item 0"],
+            ["", "00000000001", "Item 1"],
+            ["", "00000000002", "Item 2"]
+        ]
+        added = [("00000000003", "Item 3"), ("00000000004", "Item 4")]
+        recovered = [("00000000002", "Item 2")]
+        missing = [("00000000000", "Item 0")]
+        update_playlist(self.db_path, "PL0", "YOUTUBE", "Playlist", 4, "etag2", added, recovered, missing)
+        actual = read_playlist(self.db_path, "PL0")
+
+        self.assertEqual(expected, actual)
+        self.assertEqual(["5", "PL0", "Playlist", "4", "etag2"], read_header(self.db_path, "PL0")[3:])
+
+    #
+    # import_ipl_file / export_ipl_file
+    #
+
+    def test_export_import(self):
+        fpath = os.path.join(self.dir.name, "PL0.ipl")
+        export_ipl_file(self.db_path, "PL0", fpath)
+        write_playlist(self.db_path, [], "PL0", "YOUTUBE", "Empty")
+        playlist_id = import_ipl_file(self.db_path, fpath)
+
+        self.assertEqual("PL0", playlist_id)
+        self.assertEqual(self.rows, read_playlist(self.db_path, "PL0"))
+        self.assertEqual("Playlist", read_header(self.db_path, "PL0")[5])
+
+    def test_export_journaled(self):
+        fpath = os.path.join(self.dir.name, "PL0.ipl")
+        export_ipl_file(self.db_path, "PL0", fpath)
+        append_journal(os.path.join(self.dir.name, ".PL0.journal"), [("missing", "00000000001", "Item 1"), ("header", "3", "etag1")])
+        import_ipl_file(self.db_path, fpath)
+        update_playlist(self.db_path, "PL0", "YOUTUBE", "Playlist", 3, "etag2", [], [("00000000001", "Item 1")], [])
+        export_ipl_file(self.db_path, "PL0", fpath)
+        header = read_header_file(fpath, os.path.join(self.dir.name, ".PL0.journal"))
+        rows = list(iter_playlist_file(fpath))[1:]
+
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, ".PL0.journal")))
+        self.assertEqual(["3", "PL0", "Playlist", "3", "etag2"], header[3:])
+        self.assertEqual(self.rows, rows)
+        self.assertTrue(is_manifest_current(self.dir.name, "PL0", read_manifest(self.dir.name)["PL0"]))
+
+    def test_import_version_1_1(self):
+        fpath = os.path.join(self.dir.name, "PL1.ipl")
+        with open(fpath, 'w') as file:
+            file.write("#IPL,1.1,YOUTUBE,1,PL1,Old\n,00000000005,Item 5\n")
+        import_ipl_file(self.db_path, fpath)
+
+        self.assertEqual(["#IPL", "1.3", "YOUTUBE", "1", "PL1", "Old", "", ""], read_header(self.db_path, "PL1"))
+        self.assertEqual([["", "00000000005", "Item 5"]], read_playlist(self.db_path, "PL1"))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+# A local stand-in for the parts of the YouTube Data API v3 used by the
+# youtube script, for load testing without spending real quota. Point the
+# script at it with `api_url = http://127.0.0.1:8080/youtube/v3` in the
+# config file.
+
+MAX_RESULTS = 50
+
+class MockYouTubeApi:
+    """The state of the mock API, shared by every request handler.
+
+    Parameters
+    ----------
+    sizes : dict
+        The number of items in specific playlists, formatted as { playlist_id : size }.
+    default_size : int
+        The number of items in any other playlist.
+    latency : float
+        Seconds to wait before answering each request.
+    quota : int
+        Requests answered before every request fails with a 403
+        quotaExceeded error, or None for no limit.
+    fail_every : int
+        Every nth request fails with a 503 error and a Retry-After of
+        retry_after seconds, or None for no failures.
+    retry_after : int
+        The Retry-After sent with each failure.
+    inaccessible : set
+        The playlist ids whose items fail with a 403
+        playlistItemsNotAccessible error.
+    """
+
+    def __init__(self, sizes=None, default_size=100, latency=0, quota=None, fail_every=None, retry_after=0, inaccessible=()):
+        self.sizes = sizes or {}
+        self.default_size = default_size
+        self.latency = latency
+        self.quota = quota
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.inaccessible = set(inaccessible)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def size(self, playlist_id):
+        return self.sizes.get(playlist_id, self.default_size)
+
+    def use_quota(self):
+        with self.lock:
+            self.requests += 1
+            return self.quota is None or self.requests <= self.quota
+
+    def should_fail(self):
+        with self.lock:
+            return self.fail_every is not None and self.requests % self.fail_every == 0
+
+    def channels(self, query):
+        return {
+            "kind": "youtube#channelListResponse",
+            "items": [{ "snippet": { "title": "Mock User", "description": "" } }]
+        }
+
+    def playlists(self, query):
+        ids = query.get("id", "").split(",")
+        return {
+            "kind": "youtube#playlistListResponse",
+            "items": [{
+                "id": id,
+                "etag": etag(["playlist", id, self.size(id)]),
+                "snippet": { "title": f"Mock Playlist {id}", "description": "" },
+                "contentDetails": { "itemCount": self.size(id) }
+            } for id in ids if id]
+        }
+
+    def playlist_items(self, query):
+        id = query.get("playlistId", "")
+        size = self.size(id)
+        page_size = min(int(query.get("maxResults", 5)), MAX_RESULTS)
+        token = query.get("pageToken", "")
+        offset = int(token[len("OFFSET"):]) if token.startswith("OFFSET") else 0
+
+        # The real API sends every snippet field unless a fields filter is
+        # given, so the unfiltered response is padded the same way.
+        full = "fields" not in query
+        items = []
+        for i in range(offset, min(offset + page_size, size)):
+            snippet = { "title": f"Mock Video {i}", "resourceId": { "kind": "youtube#video", "videoId": f"{i:011d}" } }
+            if full:
+                snippet.update({
+                    "playlistId": id,
+                    "position": i,
+                    "description": f"Description of mock video {i}. " * 8,
+                    "channelTitle": "Mock Channel",
+                    "thumbnails": { name: { "url": f"https://i.ytimg.com/vi/{i:011d}/{name}.jpg", "width": 480, "height": 360 }
+                        for name in ["default", "medium", "high", "standard", "maxres"] }
+                })
+            items.append({ "snippet": snippet })
+
+        res = { "items": items, "pageInfo": { "totalResults": size, "resultsPerPage": page_size } }
+        if offset + page_size < size:
+            res["nextPageToken"] = f"OFFSET{offset + page_size}"
+
+        return res
+
+def etag(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+def quota_error():
+    return {
+        "error": {
+            "code": 403,
+            "message": "The request cannot be completed because you have exceeded your quota.",
+            "errors": [{ "message": "quota exceeded", "domain": "youtube.quota", "reason": "quotaExceeded" }]
+        }
+    }
+
+def inaccessible_error():
+    return {
+        "error": {
+            "code": 403,
+            "message": "The request is not properly authorized to retrieve the specified playlist.",
+            "errors": [{ "message": "forbidden", "domain": "youtube.playlistItem", "reason": "playlistItemsNotAccessible" }]
+        }
+    }
+
+def unavailable_error():
+    return {
+        "error": {
+            "code": 503,
+            "message": "The service is currently unavailable.",
+            "errors": [{ "message": "backend error", "domain": "global", "reason": "backendError" }]
+        }
+    }
+
+class MockYouTubeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api = None
+
+    routes = {
+        "/youtube/v3/channels": MockYouTubeApi.channels,
+        "/youtube/v3/playlists": MockYouTubeApi.playlists,
+        "/youtube/v3/playlistItems": MockYouTubeApi.playlist_items
+    }
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        if self.api.latency > 0:
+            time.sleep(self.api.latency)
+
+        if url.path not in self.routes:
+            return self.send_json(404, { "error": { "code": 404, "message": "Not Found" } })
+
+        if not self.api.use_quota():
+            return self.send_json(403, quota_error())
+
+        if self.api.should_fail():
+            return self.send_json(503, unavailable_error(), { "Retry-After": str(self.api.retry_after) })
+
+        if url.path.endswith("/playlistItems") and query.get("playlistId") in self.api.inaccessible:
+            return self.send_json(403, inaccessible_error())
+
+        res = self.routes[url.path](self.api, query)
+        res["etag"] = etag(res)
+
+        if self.headers.get("If-None-Match") == res["etag"]:
+            self.send_response(304)
+            self.send_header("ETag", res["etag"])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_json(200, res)
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(content)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        if "etag" in body:
+            self.send_header("ETag", body["etag"])
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(api, port=0):
+    """Starts the mock API on a background thread.
+
+    Returns
+    -------
+    tuple
+        the running server, and the base url to use as the api_url
+    """
+    handler = type("Handler", (MockYouTubeHandler,), { "api": api })
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return (server, f"http://127.0.0.1:{server.server_address[1]}/youtube/v3")
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local mock of the YouTube Data API v3 for load testing.')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='port to listen on.')
+    parser.add_argument('-s', '--size', type=int, default=100, help='number of items in each playlist.')
+    parser.add_argument('-l', '--latency', type=int, default=0, help='milliseconds to wait before each response.')
+    parser.add_argument('-q', '--quota', type=int, help='number of requests answered before returning 403 quota errors.')
+    parser.add_argument('-f', '--fail-every', type=int, help='answer every nth request with a 503 error.')
+    parser.add_argument('--playlist', nargs='+', default=[], metavar='ID=SIZE', help='number of items in specific playlists.')
+    args = parser.parse_args()
+
+    sizes = { id: int(size) for (id, size) in (p.split('=') for p in args.playlist) }
+    api = MockYouTubeApi(sizes, args.size, args.latency / 1000, args.quota, args.fail_every)
+
+    (server, url) = start_server(api, args.port)
+    print(f"Serving mock YouTube Data API at {url}")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+
+tst_dir = os.path.dirname(__file__)
+src_dir = os.path.join(tst_dir, '../src')
+sys.path.append(src_dir)
+
+from profiler import Profiler
+
+class TestProfiler(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    def setUp(self):
+        self.profiler = Profiler()
+        self.profiler.enabled = True
+
+    #
+    # span
+    #
+
+    def test_span_disabled(self):
+        self.profiler.enabled = False
+        with self.profiler.span("read") as span:
+            span["rows"] = 10
+
+        self.assertEqual([], self.profiler.spans)
+
+    def test_span_playlist(self):
+        with self.profiler.span("sync", playlist="PL0"):
+            with self.profiler.span("api", bytes=100):
+                pass
+            self.profiler.record(rows=5)
+        with self.profiler.span("api", bytes=50):
+            pass
+
+        actual = self.profiler.summary()
+
+        self.assertEqual(["PL0"], list(actual["playlists"]))
+        self.assertEqual(1, actual["playlists"]["PL0"]["api_calls"])
+        self.assertEqual(100, actual["playlists"]["PL0"]["bytes"])
+        self.assertEqual(5, actual["playlists"]["PL0"]["rows"])
+        self.assertEqual(2, actual["total"]["api_calls"])
+        self.assertEqual(150, actual["total"]["bytes"])
+
+    #
+    # timed
+    #
+
+    def test_timed(self):
+        @self.profiler.timed
+        def read_file():
+            self.profiler.record(rows=3)
+            return "rows"
+
+        self.assertEqual("rows", read_file())
+        self.assertEqual("read_file", self.profiler.spans[0]["name"].split(".")[-1])
+        self.assertEqual({ "rows": 3 }, self.profiler.spans[0]["args"])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import email.utils
+import os
+import sys
+import time
+import unittest
+
+tst_dir = os.path.dirname(__file__)
+src_dir = os.path.join(tst_dir, '../src')
+sys.path.append(src_dir)
+
+from retry import CircuitBreaker
+from retry import CircuitOpenError
+from retry import RateLimiter
+from retry import RetryableError
+from retry import RetryPolicy
+from retry import call_with_retry
+from retry import parse_retry_after
+
+class TestRetry(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    def setUp(self):
+        self.policy = RetryPolicy(retries=3, base=0.001)
+        self.calls = 0
+
+    def failing(self, failures, retry_after=None):
+        def fn():
+            self.calls += 1
+            if self.calls <= failures:
+                raise RetryableError("Status 503", retry_after)
+            return "ok"
+        return fn
+
+    #
+    # call_with_retry
+    #
+
+    def test_call_with_retry(self):
+        actual = call_with_retry(self.failing(2), self.policy)
+
+        self.assertEqual("ok", actual)
+        self.assertEqual(3, self.calls)
+
+    def test_call_with_retry_exhausted(self):
+        with self.assertRaises(RetryableError):
+            call_with_retry(self.failing(10), self.policy)
+
+        self.assertEqual(4, self.calls)
+
+    def test_call_with_retry_other_error(self):
+        def fn():
+            self.calls += 1
+            raise KeyError("items")
+
+        with self.assertRaises(KeyError):
+            call_with_retry(fn, self.policy)
+
+        self.assertEqual(1, self.calls)
+
+    def test_call_with_retry_after(self):
+        limiter = RateLimiter()
+        start = time.monotonic()
+        call_with_retry(self.failing(1, retry_after=0.1), self.policy, limiter)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertGreater(limiter.until, start)
+
+    def test_call_with_retry_after_zero(self):
+        policy = RetryPolicy(retries=3, base=0.05)
+        policy.delay = lambda attempt: 0.05
+        start = time.monotonic()
+        call_with_retry(self.failing(1, retry_after=0), policy, RateLimiter())
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    #
+    # CircuitBreaker
+    #
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+
+        with self.assertRaises(CircuitOpenError):
+            call_with_retry(self.failing(10), self.policy, breaker=breaker)
+
+        self.assertEqual(2, self.calls)
+
+    def test_circuit_breaker_cooldown(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0)
+        actual = call_with_retry(self.failing(2), self.policy, breaker=breaker)
+
+        self.assertEqual("ok", actual)
+        self.assertEqual(0, breaker.failures)
+
+    #
+    # parse_retry_after
+    #
+
+    def test_parse_retry_after(self):
+        self.assertEqual(120.0, parse_retry_after("120"))
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+
+    def test_parse_retry_after_date(self):
+        value = email.utils.formatdate(time.time() + 60, usegmt=True)
+
+        self.assertAlmostEqual(60, parse_retry_after(value), delta=2)
+
+if __name__=='__main__':
+    unittest.main()
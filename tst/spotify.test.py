@@ -0,0 +1,141 @@
+import contextlib
+import http.server
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+tst_dir = os.path.dirname(__file__)
+src_dir = os.path.join(tst_dir, '../src')
+sys.path.append(src_dir)
+
+import spotify
+import spotipy
+
+from spotify import create_session
+from spotify import fetch_pages
+from spotify import sync_playlist
+from retry import RateLimiter
+from retry import RetryableError
+from retry import RetryPolicy
+
+class RateLimitedHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = json.dumps({ "error": { "status": 429, "message": "API rate limit exceeded" } }).encode()
+        self.send_response(429)
+        self.send_header("Retry-After", "7")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestSpotifyFetch(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    def setUp(self):
+        self.saved = (spotify.workers, spotify.retry_policy, spotify.rate_limiter)
+        spotify.workers = 4
+        spotify.retry_policy = RetryPolicy(retries=3, base=0.001)
+        spotify.rate_limiter = RateLimiter()
+        self.calls = {}
+
+    def tearDown(self):
+        (spotify.workers, spotify.retry_policy, spotify.rate_limiter) = self.saved
+
+    def fetch_page(self, total, limit, failures=0, retry_after=None):
+        """Returns a fake page fetcher, which answers later pages first and
+        fails the first failures calls for each offset with a 429."""
+        lock = threading.Lock()
+
+        def fetch(offset):
+            with lock:
+                self.calls[offset] = self.calls.get(offset, 0) + 1
+                calls = self.calls[offset]
+            if calls <= failures:
+                headers = { "Retry-After": retry_after } if retry_after is not None else None
+                raise spotipy.SpotifyException(429, -1, "rate limited", headers=headers)
+
+            time.sleep(0.001 * (total - offset) / limit)
+            items = { f"{i:05d}": f"Song {i}" for i in range(offset, min(offset + limit, total)) }
+            return (items, offset + len(items), total)
+
+        return fetch
+
+    #
+    # fetch_pages
+    #
+
+    def test_fetch_pages_order(self):
+        actual = fetch_pages(self.fetch_page(95, 10), 10)
+
+        self.assertEqual([f"{i:05d}" for i in range(95)], list(actual))
+        self.assertEqual(10, len(self.calls))
+
+    def test_fetch_pages_retry(self):
+        actual = fetch_pages(self.fetch_page(30, 10, failures=1), 10)
+
+        self.assertEqual(30, len(actual))
+        self.assertEqual({ 0: 2, 10: 2, 20: 2 }, self.calls)
+
+    def test_fetch_pages_retry_after(self):
+        start = time.monotonic()
+        fetch_pages(self.fetch_page(10, 10, failures=1, retry_after="0.05"), 10)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertGreater(spotify.rate_limiter.until, start)
+
+    #
+    # sync_playlist
+    #
+
+    def test_sync_playlist_unavailable(self):
+        def fetch():
+            raise RetryableError("Status 503 fetching offset 0")
+
+        with tempfile.TemporaryDirectory() as dir:
+            (path, spotify.path) = (spotify.path, dir)
+            try:
+                with self.assertRaises(RetryableError), contextlib.redirect_stdout(io.StringIO()) as output:
+                    sync_playlist("PL0", "Playlist", fetch)
+                files = os.listdir(dir)
+            finally:
+                spotify.path = path
+
+        self.assertIn("Could not fetch playlist", output.getvalue())
+        self.assertEqual([], files)
+
+    #
+    # create_session
+    #
+
+    def test_create_session_retry_after(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), RateLimitedHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = spotipy.Spotify(auth="token", requests_session=create_session())
+        client.prefix = f"http://127.0.0.1:{server.server_port}/v1/"
+        requests_made = spotify.requests_made
+
+        try:
+            with self.assertRaises(spotipy.SpotifyException) as context:
+                client.current_user()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(429, context.exception.http_status)
+        self.assertEqual("7", context.exception.headers["Retry-After"])
+        self.assertEqual(requests_made + 1, spotify.requests_made)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+tst_dir = os.path.dirname(__file__)
+src_dir = os.path.join(tst_dir, '../src')
+sys.path.append(src_dir)
+
+import ipl_print
+import youtube
+from ipl_file import Row
+
+SIZES = [1000, 10000, 100000]
+
+# Share of the stored playlist changed before each diff
+ADDED_RATIO = 0.05
+REMOVED_RATIO = 0.05
+RENAMED_RATIO = 0.02
+RECOVERED_RATIO = 0.01
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time the diff and file paths of the youtube script on synthetic playlists.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES, help='playlist sizes to benchmark.')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of runs of each benchmark, the fastest is kept.')
+    parser.add_argument('-o', '--output', help='save the results to a json file.')
+    parser.add_argument('-c', '--compare', help='compare the results with a json file saved by an earlier run.')
+    parser.add_argument('-t', '--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression.')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic playlists.')
+
+    return parser.parse_args(argv)
+
+def make_playlist(size, rng):
+    """Builds a stored playlist and a fetched playlist that differs from it
+    by the configured ratios of added, removed, renamed and recovered items.
+
+    Returns
+    -------
+    tuple
+        the stored items formatted as [Row], and the fetched items
+        formatted as { video_id : title }
+    """
+    master = [Row("", f"{i:011d}", f"Artist {i % 997} - Song Title {i}") for i in range(size)]
+
+    for row in rng.sample(master, int(size * RECOVERED_RATIO)):
+        row[0] = youtube.MISSING_FLAG
+
+    removed = { row[1] for row in rng.sample(master, int(size * REMOVED_RATIO)) }
+    renamed = { row[1] for row in rng.sample(master, int(size * RENAMED_RATIO)) }
+
+    new_items = { f"{size + i:011d}": f"Artist {i % 997} - New Song {i}" for i in range(int(size * ADDED_RATIO)) }
+    for [_, id, title] in master:
+        if id not in removed:
+            new_items[id] = f"{title} (Remastered)" if id in renamed else title
+
+    return (master, new_items)
+
+def copy_playlist(master):
+    return [Row(flag, id, title) for [flag, id, title] in master]
+
+def best_time(fn, setup, repeat):
+    """Runs fn on a fresh result of setup repeat times and returns the
+    fastest run in seconds. Setup is not timed."""
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def bench_size(size, repeat, seed, dir):
+    (master, new_items) = make_playlist(size, random.Random(seed + size))
+    playlist_id = f"PLBENCH{size}"
+    fresh = lambda: copy_playlist(master)
+    results = {}
+
+    results["find_added_items"] = best_time(lambda m: youtube.find_added_items(m, new_items), fresh, repeat)
+    results["find_recovered_items"] = best_time(lambda m: youtube.find_recovered_items(m, new_items), fresh, repeat)
+    results["find_missing_items"] = best_time(lambda m: youtube.find_missing_items(m, new_items), fresh, repeat)
+    results["find_renamed_items"] = best_time(lambda m: youtube.find_renamed_items(m, new_items), fresh, repeat)
+    results["diff_playlist"] = best_time(lambda m: youtube.diff_playlist(m, new_items), fresh, repeat)
+
+    youtube.path = dir
+    youtube.storage = "csv"
+    youtube.backups = 0
+
+    results["write_playlist_file"] = best_time(
+        lambda m: youtube.write_playlist_file(m, playlist_id, "Benchmark", size, "etag"), lambda: master, repeat)
+    results["read_playlist_file"] = best_time(
+        lambda id: youtube.read_playlist_file(id), lambda: playlist_id, repeat)
+
+    config_path = os.path.join(dir, "config.ini")
+    with open(config_path, 'w') as file:
+        file.write(f"[params]\npath = {dir}\n")
+    ipl_print.config_path = config_path
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results["ipl_print.main"] = best_time(
+            lambda argv: ipl_print.main(argv), lambda: ["-p", playlist_id], repeat)
+
+    return results
+
+def print_results(results, previous=None, threshold=1.2):
+    """Prints a table of the results, and the change from a previous run.
+
+    Returns
+    -------
+    list
+        the benchmarks that are slower than the previous run by more
+        than the threshold, formatted as (size, name, ratio)
+    """
+    regressions = []
+
+    for (size, timings) in results.items():
+        print(f"{int(size):,} items")
+        for (name, seconds) in timings.items():
+            line = f"  {name:24} {seconds * 1000:10.2f} ms"
+
+            old = previous.get(size, {}).get(name) if previous is not None else None
+            if old:
+                ratio = seconds / old
+                line += f"  {ratio:5.2f}x"
+                if ratio > threshold:
+                    line += "  (regression)"
+                    regressions.append((size, name, ratio))
+
+            print(line)
+        print()
+
+    return regressions
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as dir:
+        for size in args.sizes:
+            results[str(size)] = bench_size(size, args.repeat, args.seed, dir)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            previous = json.load(file)["results"]
+
+    regressions = print_results(results, previous, args.threshold)
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({
+                "timestamp": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "repeat": args.repeat,
+                "seed": args.seed,
+                "results": results
+            }, file, indent=2)
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
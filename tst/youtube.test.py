@@ -1,15 +1,59 @@
+import contextlib
+import datetime
+import gzip
+import http.server
+import io
+import json
 import os
+import requests
 import sys
+import tempfile
+import threading
 import unittest
 
 tst_dir = os.path.dirname(__file__)
 src_dir = os.path.join(tst_dir, '../src')
 sys.path.append(src_dir)
 
+import youtube
+
 from youtube import find_added_items
 from youtube import find_recovered_items
 from youtube import find_missing_items
 from youtube import find_renamed_items
+from youtube import diff_playlist
+from youtube import PageEtags
+from youtube import PlaylistDiff
+from youtube import compact_playlist_file
+from youtube import ApiClient
+from youtube import fetch_playlist
+from youtube import failed_result
+from youtube import fetch_playlist_details
+from youtube import is_walk_due
+from youtube import schedule_playlists
+from youtube import print_sync_result
+from youtube import read_playlist_file
+from youtube import sync_playlist
+from ipl_file import is_manifest_current
+from ipl_file import read_manifest
+from ipl_file import title_store
+from retry import RetryPolicy
+from mock_youtube_server import MockYouTubeApi
+from mock_youtube_server import start_server
+
+class GzipHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = gzip.compress(json.dumps({ "items": [{ "title": "Mock Video" }] * 100 }).encode())
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 class TestYoutubeDiff(unittest.TestCase):
 
@@ -170,5 +214,446 @@ class TestYoutubeDiff(unittest.TestCase):
 
         self.assertEqual(expected, self.old_items)
 
+    #
+    # diff_playlist
+    #
+
+    def test_diff_playlist(self):
+        expected = (
+            [("00000000005", "Item 5")],
+            [],
+            [("00000000003", "Item 3")],
+            [("00000000000", "Item 0", "Item 0 (New)")]
+        )
+        actual = diff_playlist(self.old_items, self.new_items)
+
+        self.assertEqual(expected, actual)
+
+    def test_diff_playlist_master(self):
+        expected = [
+            ["", "00000000005", "Item 5"],
+            ["", "00000000000", "Item 0"],
+            ["", "00000000001", "Item 1"],
+            ["", "00000000002", "Item 2"],
+            ["!", "00000000003", "Item 3"],
+            ["!", "00000000004", "Item 4"]
+        ]
+        actual = diff_playlist(self.old_items, self.new_items)
+
+        self.assertEqual(expected, self.old_items)
+
+    def test_diff_playlist_recovered(self):
+        expected = [
+            ("00000000001", "Item 1")
+        ]
+        self.old_items[1][0] = "!"
+        (_, actual, _, _) = diff_playlist(self.old_items, self.new_items)
+
+        self.assertEqual(expected, actual)
+        self.assertEqual("", self.old_items[2][0])
+
+    def test_diff_playlist_matches_find_items(self):
+        self.old_items[1][0] = "!"
+        master = [list(row) for row in self.old_items]
+
+        expected = (
+            find_added_items(master, self.new_items),
+            find_recovered_items(master, self.new_items),
+            find_missing_items(master, self.new_items),
+            find_renamed_items(master, self.new_items)
+        )
+        actual = diff_playlist(self.old_items, self.new_items)
+
+        self.assertEqual(expected, actual)
+        self.assertEqual(master, self.old_items)
+
+    def test_diff_playlist_empty_master(self):
+        expected = [
+            ["", "00000000000", "Item 0 (New)"],
+            ["", "00000000001", "Item 1"],
+            ["", "00000000002", "Item 2"],
+            ["", "00000000005", "Item 5"]
+        ]
+        self.old_items = []
+        actual = diff_playlist(self.old_items, self.new_items)
+
+        self.assertEqual(expected, self.old_items)
+
+    #
+    # PlaylistDiff
+    #
+
+    def test_playlist_diff_pages(self):
+        self.old_items[1][0] = "!"
+        master = [list(row) for row in self.old_items]
+        expected = diff_playlist(master, self.new_items)
+
+        differ = PlaylistDiff(self.old_items)
+        differ.update({ "00000000000": "Item 0 (New)", "00000000001": "Item 1" })
+        differ.update({ "00000000002": "Item 2", "00000000001": "Item 1" })
+        differ.update({ "00000000005": "Item 5" })
+        actual = differ.finish()
+
+        self.assertEqual(expected, actual)
+        self.assertEqual(master, self.old_items)
+
+class TestYoutubeFetch(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    @classmethod
+    def setUpClass(cls):
+        (cls.server, cls.url) = start_server(MockYouTubeApi({ "PL0": 120 }))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.saved = (youtube.path, youtube.checkpoint_ttl)
+        self.dir = tempfile.TemporaryDirectory()
+        youtube.path = self.dir.name
+        self.client = ApiClient("key", base_url=self.url)
+
+    def tearDown(self):
+        (youtube.path, youtube.checkpoint_ttl) = self.saved
+        self.client.close()
+        self.dir.cleanup()
+
+    #
+    # fetch_playlist
+    #
+
+    def test_fetch_playlist(self):
+        (actual, modified) = fetch_playlist(self.client, "PL0", show_progress=False)
+
+        self.assertEqual(120, len(actual))
+        self.assertEqual("Mock Video 119", actual["00000000119"])
+        self.assertEqual(3, self.client.requests)
+        self.assertTrue(modified)
+
+    def test_fetch_playlist_retry(self):
+        (server, url) = start_server(MockYouTubeApi({ "PL0": 120 }, fail_every=2))
+        client = ApiClient("key", base_url=url)
+        client.policy = RetryPolicy(base=0.01)
+
+        try:
+            (actual, _) = fetch_playlist(client, "PL0", show_progress=False)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(120, len(actual))
+        self.assertEqual(5, client.requests)
+
+    def test_fetch_playlist_etags(self):
+        youtube.checkpoint_ttl = 0
+        with tempfile.TemporaryDirectory() as dir:
+            etags = PageEtags(os.path.join(dir, ".PL0.etag"))
+            fetch_playlist(self.client, "PL0", False, etags)
+            etags.save()
+
+            etags = PageEtags(os.path.join(dir, ".PL0.etag"))
+            etags.load()
+            (actual, modified) = fetch_playlist(self.client, "PL0", False, etags)
+            etags.save()
+            files = os.listdir(dir)
+
+        self.assertEqual(120, len(actual))
+        self.assertEqual("Mock Video 119", actual["00000000119"])
+        self.assertEqual(["", "OFFSET50", "OFFSET100"], list(etags.pages))
+        self.assertNotIn("items", etags.pages[""])
+        self.assertFalse(modified)
+        self.assertEqual([".PL0.etag"], files)
+
+    def test_page_etags_earlier_version(self):
+        with tempfile.TemporaryDirectory() as dir:
+            etags = PageEtags(os.path.join(dir, ".PL0.etag"))
+            with open(etags.fpath, 'w') as file:
+                json.dump({ "pages": { "": { "etag": "etag 0", "items": { "00000000000": "Item 0" }, "next": None, "count": 1 } } }, file)
+
+            etags.load()
+            items = etags.read_items("")
+            with open(etags.fpath, 'r') as file:
+                lines = file.read().splitlines()
+
+        self.assertEqual("etag 0", etags.pages[""]["etag"])
+        self.assertEqual({ "00000000000": "Item 0" }, items)
+        self.assertEqual("", json.loads(lines[0])["token"])
+
+    def test_page_etags_mode(self):
+        with tempfile.TemporaryDirectory() as dir:
+            etags = PageEtags(os.path.join(dir, ".PL0.etag"))
+            etags.begin()
+            etags.add("", "etag 0", { "00000000000": "Item 0" }, None, 1)
+            etags.end()
+            etags.begin()
+            etags.end()
+            etags.save()
+            with open(os.path.join(dir, "PL0.ipl"), 'w') as file:
+                file.write("")
+
+            actual = os.stat(etags.fpath).st_mode
+            expected = os.stat(os.path.join(dir, "PL0.ipl")).st_mode
+            files = os.listdir(dir)
+
+        self.assertEqual(expected, actual)
+        self.assertEqual([".PL0.etag", "PL0.ipl"], sorted(files))
+
+    def test_fetch_playlist_checkpoint(self):
+        with tempfile.TemporaryDirectory() as dir:
+            (youtube.path, youtube.checkpoint_ttl) = (dir, 60)
+            fetch_playlist(self.client, "PL0", False)
+            (actual, _) = fetch_playlist(self.client, "PL0", False)
+
+        self.assertEqual(120, len(actual))
+        self.assertEqual(3, self.client.requests)
+
+    def test_fetch_playlist_checkpoint_expired(self):
+        with tempfile.TemporaryDirectory() as dir:
+            (youtube.path, youtube.checkpoint_ttl) = (dir, 60)
+            with open(os.path.join(dir, ".PL0.checkpoint"), 'w') as file:
+                file.write('{"created": "2020-01-01T00:00:00"}\n{"token": "", "etag": null, "next": null, "count": 1, "modified": true, "items": {"0": "Old"}}\n')
+            (actual, _) = fetch_playlist(self.client, "PL0", False)
+
+        self.assertEqual(120, len(actual))
+
+    def test_fetch_playlist_details(self):
+        actual = fetch_playlist_details(self.client, ["PL0", "PL0"])
+
+        self.assertEqual(["PL0"], list(actual))
+        self.assertEqual(120, actual["PL0"]["count"])
+
+    #
+    # ApiClient
+    #
+
+    def test_api_client_bytes_received(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), GzipHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = ApiClient("key", base_url=f"http://127.0.0.1:{server.server_port}")
+
+        try:
+            res = client.get("playlists", {})
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(int(res.headers["Content-Length"]), client.bytes_received)
+        self.assertLess(client.bytes_received, len(res.content))
+
+class TestYoutubeSchedule(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    def setUp(self):
+        self.saved = (youtube.path, youtube.quota, youtube.priorities, youtube.precheck, youtube.precheck_max_age)
+        self.dir = tempfile.TemporaryDirectory()
+        youtube.path = self.dir.name
+        youtube.quota = 10
+        youtube.priorities = {}
+        self.details = {
+            "PL0": { "title": "Playlist 0", "count": 120, "etag": "etag 0" },
+            "PL1": { "title": "Playlist 1", "count": 50, "etag": "etag 1" },
+            "PL2": { "title": "Playlist 2", "count": 400, "etag": "etag 2" }
+        }
+        self.schedule = { "date": "", "used": 0, "synced": { "PL0": "2020-01-02", "PL1": "2020-01-01" } }
+
+    def tearDown(self):
+        (youtube.path, youtube.quota, youtube.priorities, youtube.precheck, youtube.precheck_max_age) = self.saved
+        self.dir.cleanup()
+
+    #
+    # schedule_playlists
+    #
+
+    def test_schedule_playlists_staleness(self):
+        expected = (["PL2", "PL1", "PL0"], [], [])
+        youtube.quota = 100
+        actual = schedule_playlists(["PL0", "PL1", "PL2", "PL0"], self.details, self.schedule, 0)
+
+        self.assertEqual(expected, actual)
+
+    def test_schedule_playlists_priority(self):
+        expected = (["PL0", "PL2", "PL1"], [], [])
+        youtube.quota = 100
+        youtube.priorities = { "PL0": 1 }
+        actual = schedule_playlists(["PL0", "PL1", "PL2"], self.details, self.schedule, 0)
+
+        self.assertEqual(expected, actual)
+
+    def test_schedule_playlists_quota(self):
+        expected = (["PL2", "PL1"], ["PL0"], [])
+        actual = schedule_playlists(["PL0", "PL1", "PL2"], self.details, self.schedule, 1)
+
+        self.assertEqual(expected, actual)
+
+    def test_schedule_playlists_quota_skip(self):
+        expected = (["PL1", "PL0"], ["PL2"], [])
+        actual = schedule_playlists(["PL0", "PL1", "PL2"], self.details, self.schedule, 4)
+
+        self.assertEqual(expected, actual)
+
+    def test_schedule_playlists_oversized(self):
+        expected = (["PL1", "PL0"], [], ["PL2"])
+        youtube.quota = 5
+        actual = schedule_playlists(["PL0", "PL1", "PL2"], self.details, self.schedule, 0)
+
+        self.assertEqual(expected, actual)
+
+    #
+    # is_walk_due
+    #
+
+    def test_is_walk_due(self):
+        youtube.precheck_max_age = 24
+        self.schedule["walked"] = { "PL0": datetime.datetime.now().isoformat(), "PL1": "2020-01-01T00:00:00" }
+
+        self.assertFalse(is_walk_due(self.schedule, "PL0"))
+        self.assertTrue(is_walk_due(self.schedule, "PL1"))
+        self.assertTrue(is_walk_due(self.schedule, "PL2"))
+
+class TestYoutubeSync(unittest.TestCase):
+
+    #
+    # Setup
+    #
+
+    @classmethod
+    def setUpClass(cls):
+        (cls.server, cls.url) = start_server(MockYouTubeApi({ "PL0": 3 }))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.saved = (youtube.path, youtube.storage, youtube.journal, youtube.precheck, youtube.precheck_max_age)
+        self.dir = tempfile.TemporaryDirectory()
+        (youtube.path, youtube.storage, youtube.journal, youtube.precheck) = (self.dir.name, "csv", True, False)
+        title_store.clear()
+        self.client = ApiClient("key", base_url=self.url)
+        self.details = fetch_playlist_details(self.client, ["PL0"])["PL0"]
+
+        with open(os.path.join(self.dir.name, "PL0.ipl"), 'w') as file:
+            file.write("#IPL,1.2,YOUTUBE,3,PL0,Playlist,,\n")
+            file.write(",00000000000,Mock Video 0\n,00000000001,Old Video 1\n,00000000002,Old Video 2\n")
+
+    def tearDown(self):
+        (youtube.path, youtube.storage, youtube.journal, youtube.precheck, youtube.precheck_max_age) = self.saved
+        self.client.close()
+        self.dir.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.dir.name, name), 'r') as file:
+            return file.read()
+
+    #
+    # sync_playlist
+    #
+
+    def test_sync_playlist_renames(self):
+        first = sync_playlist(self.client, "PL0", self.details, show_progress=False)
+        second = sync_playlist(self.client, "PL0", self.details, show_progress=False)
+
+        self.assertEqual(2, len(first["new_renamed"]))
+        self.assertTrue(first["journaled"])
+        self.assertFalse(second["renames_changed"])
+        self.assertEqual("Mock Video 1", read_playlist_file("PL0")[1].rename)
+
+    def test_sync_playlist_cache_file(self):
+        with open(os.path.join(self.dir.name, ".PL0.cache"), 'w') as file:
+            file.write("00000000001,Mock Video 1\n")
+
+        actual = sync_playlist(self.client, "PL0", self.details, show_progress=False)
+
+        self.assertEqual(["00000000002"], [item[0] for item in actual["new_renamed"]])
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, ".PL0.cache")))
+        self.assertTrue(self.read("PL0.ipl").startswith("#IPL,1.3,"))
+        self.assertIn(",00000000001,Old Video 1,Mock Video 1\n", self.read("PL0.ipl"))
+
+    def test_print_sync_result_first_rename(self):
+        result = sync_playlist(self.client, "PL0", self.details, show_progress=False)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            print_sync_result(dict(result, playlist="PL1"))
+            print_sync_result(result)
+
+        self.assertEqual(1, output.getvalue().count("Old Video 1"))
+        self.assertLess(output.getvalue().index("Old Video 1"), output.getvalue().index("[PL0]"))
+
+    def test_sync_playlist_truncated(self):
+        sync_playlist(self.client, "PL0", self.details, show_progress=False)
+        with open(os.path.join(self.dir.name, "PL0.ipl"), 'r') as file:
+            lines = file.readlines()
+        with open(os.path.join(self.dir.name, "PL0.ipl"), 'w') as file:
+            file.writelines(lines[:-1])
+
+        actual = sync_playlist(self.client, "PL0", self.details, show_progress=False)
+
+        self.assertTrue(actual["read_error"])
+
+    def test_print_sync_result_fetch_error(self):
+        (server, url) = start_server(MockYouTubeApi({ "PL0": 3 }, inaccessible={ "PL0" }))
+        client = ApiClient("key", base_url=url)
+
+        try:
+            with self.assertRaises(requests.HTTPError) as context:
+                sync_playlist(client, "PL0", self.details, show_progress=False)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            print_sync_result(failed_result("PL0", self.details, context.exception))
+
+        self.assertIn("403 playlistItemsNotAccessible", output.getvalue())
+        self.assertIn(",00000000001,Old Video 1", self.read("PL0.ipl"))
+
+    def test_sync_playlist_walk(self):
+        sync_playlist(self.client, "PL0", self.details, show_progress=False)
+        youtube.precheck = True
+
+        skipped = sync_playlist(self.client, "PL0", self.details, show_progress=False)
+        walked = sync_playlist(self.client, "PL0", self.details, show_progress=False, walk=True)
+
+        self.assertFalse(skipped["walked"])
+        self.assertTrue(walked["walked"])
+
+    #
+    # compact_playlist_file
+    #
+
+    def test_compact_playlist_file_manifest(self):
+        sync_playlist(self.client, "PL0", self.details, show_progress=False)
+        compact_playlist_file("PL0")
+        entry = read_manifest(self.dir.name)["PL0"]
+
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, ".PL0.journal")))
+        self.assertTrue(is_manifest_current(self.dir.name, "PL0", entry))
+        self.assertEqual(3, entry["count"])
+
+    def test_compact_playlist_file_truncated(self):
+        with open(os.path.join(self.dir.name, "PL0.ipl"), 'w') as file:
+            file.write("#IPL,1.3,YOUTUBE,3,PL0,Playlist,,\n,00000000000,Mock Video 0,\n,00000000001,Old Video 1,\n")
+        with open(os.path.join(self.dir.name, ".PL0.journal"), 'w') as file:
+            file.write("2020-01-01T00:00:00,add,00000000003,Item 3\n")
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            compact_playlist_file("PL0")
+
+        self.assertIn("PL0.ipl", output.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(self.dir.name, ".PL0.journal")))
+        self.assertTrue(self.read("PL0.ipl").startswith("#IPL,1.3,YOUTUBE,3,"))
+
 if __name__=='__main__':
     unittest.main()